@@ -0,0 +1,584 @@
+import sqlite3
+import json
+import sys
+import os
+import io
+import argparse
+import http.server
+import random
+import urllib.parse
+import tempfile
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+
+import KismetParse
+
+# Schema of a Kismet log database (db_version 8), as written by Kismet itself
+KISMET_SCHEMA = [
+    "CREATE TABLE KISMET (kismet_version TEXT, db_version INT, db_module TEXT)",
+    "CREATE TABLE devices (first_time INT, last_time INT, devkey TEXT, "
+    "phyname TEXT, devmac TEXT, strongest_signal INT, min_lat REAL, min_lon REAL, "
+    "max_lat REAL, max_lon REAL, avg_lat REAL, avg_lon REAL, bytes_data INT, "
+    "type TEXT, device BLOB, UNIQUE(phyname, devmac) ON CONFLICT REPLACE)",
+    "CREATE TABLE packets (ts_sec INT, ts_usec INT, phyname TEXT, sourcemac TEXT, "
+    "destmac TEXT, transmac TEXT, frequency REAL, devkey TEXT, lat REAL, lon REAL, "
+    "alt REAL, speed REAL, heading REAL, packet_len INT, signal INT, "
+    "datasource TEXT, dlt INT, packet BLOB, error INT, tags TEXT, datarate REAL, "
+    "hash INT, packetid INT, packet_full_len INT)",
+    "CREATE TABLE data (ts_sec INT, ts_usec INT, phyname TEXT, devmac TEXT, "
+    "lat REAL, lon REAL, alt REAL, speed REAL, heading REAL, datasource TEXT, "
+    "type TEXT, json BLOB)",
+    "CREATE TABLE datasources (uuid TEXT, typestring TEXT, definition TEXT, "
+    "name TEXT, interface TEXT, json BLOB, UNIQUE(uuid) ON CONFLICT REPLACE)",
+    "CREATE TABLE alerts (ts_sec INT, ts_usec INT, phyname TEXT, devmac TEXT, "
+    "lat REAL, lon REAL, header TEXT, json BLOB)",
+    "CREATE TABLE messages (ts_sec INT, lat REAL, lon REAL, msgtype TEXT, "
+    "message TEXT)",
+    "CREATE TABLE snapshots (ts_sec INT, ts_usec INT, lat REAL, lon REAL, "
+    "snaptype TEXT, json BLOB)",
+]
+
+# Relative share of each generated device kind
+DEFAULT_MIX = {
+    "btedr": 1,
+    "btle_random": 3,
+    "btle_named": 2,
+    "client": 3,
+    "ap": 1,
+    "sensor": 0.2,
+}
+
+# Kismet device type and phy name of each device kind
+DEVICE_KINDS = {
+    "btedr": ("BR/EDR", "Bluetooth"),
+    "btle_random": ("BTLE", "BTLE"),
+    "btle_named": ("BTLE", "BTLE"),
+    "client": ("Wi-Fi Client", "IEEE802.11"),
+    "ap": ("Wi-Fi AP", "IEEE802.11"),
+    "sensor": ("Sensor", "RTL433"),
+}
+
+MANUFACTURERS = ["Apple", "Intel", "Samsung", "Espressif", "Unknown"]
+SSID_POOL_SIZE = 5000
+INSERT_BATCH_SIZE = 10000
+
+DEFAULT_SIZES = [10000, 100000, 1000000]
+BENCH_STAGES = [
+    "extract_devices_json",
+    "sort_devices_to_files",
+    "load_and_sort_devices",
+    "subtract_baseline",
+    "intersect_baseline",
+    "generate_intermediate_files",
+    "generate_cleaned_database",
+]
+# Slowdowns smaller than this are timer noise, whatever their ratio
+REGRESSION_MIN_SECONDS = 0.01
+
+
+def parse_mix(text):
+    """Parse a kind=weight,... device mix, e.g. btedr=1,client=5"""
+    mix = dict.fromkeys(DEVICE_KINDS, 0)
+    for item in text.split(","):
+        kind, _, weight = item.partition("=")
+        kind = kind.strip()
+        if kind not in DEVICE_KINDS:
+            raise argparse.ArgumentTypeError(
+                f"unknown device kind {kind!r} (choose from {', '.join(DEVICE_KINDS)})"
+            )
+        try:
+            mix[kind] = float(weight)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"invalid weight for {kind}: {weight!r}")
+    if not any(weight > 0 for weight in mix.values()):
+        raise argparse.ArgumentTypeError("the device mix is empty")
+    return mix
+
+
+def random_mac(rnd, random_address=False):
+    """Random MAC address; random_address sets the BTLE random static bits"""
+    octets = [rnd.randrange(256) for _ in range(6)]
+    if random_address:
+        octets[0] |= 0xC0
+    else:
+        octets[0] &= 0x3C
+    return ":".join(f"{octet:02X}" for octet in octets)
+
+
+def make_device(rnd, kind, index, ssids):
+    """One synthetic device row and the JSON record Kismet stores alongside it"""
+    dev_type, phyname = DEVICE_KINDS[kind]
+    mac = random_mac(rnd, random_address=kind == "btle_random")
+    device_key = f"{rnd.getrandbits(64):016X}_{int(mac.replace(':', ''), 16):012X}"
+    first_time = 1700000000 + rnd.randrange(86400)
+    last_time = first_time + rnd.randrange(3600)
+    signal = -rnd.randrange(30, 100)
+
+    if kind == "btle_random":
+        # Kismet names anonymous BTLE devices after their address
+        commonname, manuf = mac, "Unknown"
+    else:
+        commonname = f"{kind}-{index}" if rnd.random() < 0.6 else mac
+        manuf = rnd.choice(MANUFACTURERS)
+
+    device = {
+        "kismet.device.base.key": device_key,
+        "kismet.device.base.macaddr": mac,
+        "kismet.device.base.phyname": phyname,
+        "kismet.device.base.type": dev_type,
+        "kismet.device.base.commonname": commonname,
+        "kismet.device.base.manuf": manuf,
+        "kismet.device.base.first_time": first_time,
+        "kismet.device.base.last_time": last_time,
+        "kismet.device.base.packets.total": rnd.randrange(1, 5000),
+        "kismet.device.base.signal": {
+            "kismet.common.signal.last_signal": signal,
+            "kismet.common.signal.max_signal": signal + rnd.randrange(10),
+        },
+    }
+    if kind == "client":
+        device["dot11.device"] = {
+            "dot11.device.probed_ssid_map": [
+                {"dot11.probedssid.ssid": rnd.choice(ssids)}
+                for _ in range(rnd.randrange(5))
+            ]
+        }
+    elif kind == "ap":
+        device["dot11.device"] = {
+            "dot11.device.advertised_ssid_map": [
+                {"dot11.advertisedssid.ssid": rnd.choice(ssids)}
+                for _ in range(rnd.randrange(1, 3))
+            ]
+        }
+
+    return (
+        first_time,
+        last_time,
+        device_key,
+        phyname,
+        mac,
+        signal,
+        0,
+        0,
+        0,
+        0,
+        0,
+        0,
+        rnd.randrange(100000),
+        dev_type,
+        json.dumps(device),
+    )
+
+
+def generate_database(
+    path, devices, mix=DEFAULT_MIX, seed=0, packets_per_device=2, data_ratio=0.3
+):
+    """
+    Write a schema-correct Kismet database with the given number of devices.
+    The same seed always produces the same devices in the same order, so a
+    smaller database generated with the same seed is a subset of a larger
+    one and serves as an overlapping baseline.
+    """
+    rnd = random.Random(seed)
+    kinds = [kind for kind in DEVICE_KINDS if mix.get(kind, 0) > 0]
+    weights = [mix[kind] for kind in kinds]
+    ssids = [f"SSID-{i}" for i in range(SSID_POOL_SIZE)] + [""]
+
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+    for statement in KISMET_SCHEMA:
+        conn.execute(statement)
+    conn.execute("INSERT INTO KISMET VALUES ('2023-07-R1', 8, 'Kismet')")
+    conn.execute(
+        "INSERT INTO datasources (uuid, typestring, name, interface, json) "
+        "VALUES ('5FE308BD-0000-0000-0000-000000000000', 'linuxwifi', 'wlan0', "
+        "'wlan0', '{}')"
+    )
+
+    device_rows, packet_rows, data_rows, alert_rows = [], [], [], []
+
+    def flush():
+        conn.executemany(
+            f"INSERT INTO devices VALUES ({', '.join('?' * 15)})", device_rows
+        )
+        conn.executemany(
+            "INSERT INTO packets (ts_sec, ts_usec, phyname, sourcemac, devkey, "
+            "packet_len, signal, packet) VALUES (?, 0, ?, ?, ?, 64, ?, ?)",
+            packet_rows,
+        )
+        conn.executemany(
+            "INSERT INTO data (ts_sec, ts_usec, phyname, devmac, type, json) "
+            "VALUES (?, 0, ?, ?, 'rtl433', '{}')",
+            data_rows,
+        )
+        conn.executemany(
+            "INSERT INTO alerts (ts_sec, ts_usec, phyname, devmac, header, json) "
+            "VALUES (?, 0, ?, ?, 'DEVICEFOUND', '{}')",
+            alert_rows,
+        )
+        for rows in (device_rows, packet_rows, data_rows, alert_rows):
+            rows.clear()
+
+    for index in range(devices):
+        kind = rnd.choices(kinds, weights)[0]
+        row = make_device(rnd, kind, index, ssids)
+        first_time, _, device_key, phyname, mac, signal = row[:6]
+        device_rows.append(row)
+        for _ in range(packets_per_device):
+            packet_rows.append(
+                (first_time, phyname, mac, device_key, signal, b"\x00" * 64)
+            )
+        if rnd.random() < data_ratio:
+            data_rows.append((first_time, phyname, mac))
+        if rnd.random() < 0.01:
+            alert_rows.append((first_time, phyname, mac))
+        if len(device_rows) >= INSERT_BATCH_SIZE:
+            flush()
+    flush()
+
+    conn.execute("INSERT INTO snapshots VALUES (1700000000, 0, 0, 0, 'SYSTEM', '{}')")
+    conn.commit()
+    conn.close()
+
+
+def measure(func, *args, memory=True, repeat=1):
+    """
+    Run func repeat times for its best wall time and, if memory is set, once
+    more under tracemalloc for its peak Python allocation (tracemalloc slows
+    the call down, so it never runs during the timed pass). Returns
+    (result, seconds, peak_bytes).
+    """
+    with redirect_stdout(io.StringIO()):
+        seconds = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = func(*args)
+            elapsed = time.perf_counter() - start
+            seconds = elapsed if seconds is None else min(seconds, elapsed)
+        peak = None
+        if memory:
+            del result
+            tracemalloc.start()
+            result = func(*args)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+    return result, seconds, peak
+
+
+def benchmark_size(
+    workdir, size, mix, seed, memory=True, stages=BENCH_STAGES, repeat=1
+):
+    """Run every stage against a database of size devices"""
+    capture_db = os.path.join(workdir, f"capture_{size}.kismet")
+    baseline_db = os.path.join(workdir, f"baseline_{size}.kismet")
+    if not os.path.exists(capture_db):
+        print(f"Generating {capture_db}")
+        generate_database(capture_db, size, mix, seed)
+    if not os.path.exists(baseline_db):
+        print(f"Generating {baseline_db}")
+        generate_database(baseline_db, size // 2, mix, seed)
+
+    results = {}
+
+    def record(stage, func, *args):
+        result, seconds, peak = measure(
+            func,
+            *args,
+            memory=memory and stage in stages,
+            repeat=repeat if stage in stages else 1,
+        )
+        if stage in stages:
+            results[stage] = {"seconds": round(seconds, 4), "peak_bytes": peak}
+            peak_text = f"{peak / 2**20:9.1f} MiB" if peak is not None else ""
+            print(f"{size:>9} {stage:<28} {seconds:9.3f} s {peak_text}")
+        return result
+
+    conn = sqlite3.connect(capture_db)
+    devices = record("extract_devices_json", KismetParse.extract_devices_json, conn)
+    conn.close()
+    record(
+        "sort_devices_to_files",
+        lambda: KismetParse.sort_devices_to_files(
+            devices, generate_files=False, track_keys=True
+        ),
+    )
+    del devices
+
+    new_data = record(
+        "load_and_sort_devices",
+        lambda: KismetParse.load_and_sort_devices(capture_db, track_keys=True),
+    )
+    with redirect_stdout(io.StringIO()):
+        baseline_data = KismetParse.load_and_sort_devices(baseline_db)
+
+    record("subtract_baseline", KismetParse.subtract_baseline, new_data, baseline_data)
+    record(
+        "intersect_baseline", KismetParse.intersect_baseline, new_data, baseline_data
+    )
+
+    output_dir = os.path.join(workdir, f"output_{size}")
+    os.makedirs(output_dir, exist_ok=True)
+    cwd = os.getcwd()
+    os.chdir(output_dir)
+    try:
+        record(
+            "generate_intermediate_files",
+            KismetParse.generate_intermediate_files,
+            *new_data.categories,
+        )
+    finally:
+        os.chdir(cwd)
+
+    cleaned_db = os.path.join(workdir, f"cleaned_{size}.kismet")
+    record(
+        "generate_cleaned_database",
+        KismetParse.generate_cleaned_database,
+        capture_db,
+        cleaned_db,
+        new_data.keys,
+    )
+    os.remove(cleaned_db)
+    return results
+
+
+def compare_results(results, previous, tolerance):
+    """Stages that got slower than previous by more than tolerance"""
+    regressions = []
+    for size, stages in results.items():
+        for stage, current in stages.items():
+            before = previous.get(size, {}).get(stage)
+            if not before or not before.get("seconds"):
+                continue
+            slowdown = current["seconds"] - before["seconds"]
+            if slowdown > REGRESSION_MIN_SECONDS and current["seconds"] > before[
+                "seconds"
+            ] * (1 + tolerance):
+                regressions.append((size, stage, before["seconds"], current["seconds"]))
+    return regressions
+
+
+class MockKismetHandler(http.server.BaseHTTPRequestHandler):
+    """
+    The part of Kismet's REST API that KismetParse --push uses: devicefound
+    targets are added, removed and listed in memory, and lost on restart
+    just as they are by Kismet. Each request is logged with the client port,
+    so reuse of the keep-alive connection shows up in the log.
+    """
+
+    protocol_version = "HTTP/1.1"
+    macs = set()
+    list_endpoint = True
+
+    def do_GET(self):
+        if self.path != KismetParse.PUSH_LIST_PATH or not self.list_endpoint:
+            return self.reply(404, {"error": "not found"})
+        self.log_request_summary(f"{len(self.macs)} targets listed")
+        self.reply(200, sorted(self.macs))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            form = urllib.parse.parse_qs(body.decode())
+            macs = {mac.upper() for mac in json.loads(form["json"][0])["macs"]}
+        except (KeyError, ValueError, TypeError):
+            return self.reply(400, {"error": 'expected json={"macs": [...]}'})
+        if self.path == KismetParse.PUSH_ADD_PATH:
+            self.macs.update(macs)
+        elif self.path == KismetParse.PUSH_REMOVE_PATH:
+            self.macs.difference_update(macs)
+        else:
+            return self.reply(404, {"error": "not found"})
+        self.log_request_summary(f"{len(macs)} targets, {len(self.macs)} held")
+        self.reply(200, {"success": True})
+
+    def reply(self, status, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_request_summary(self, summary):
+        print(
+            f"{self.command} {self.path} from port {self.client_address[1]}: {summary}"
+        )
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_mock_kismet(host, port, list_endpoint=True):
+    """Run MockKismetHandler until interrupted"""
+    MockKismetHandler.list_endpoint = list_endpoint
+    server = http.server.ThreadingHTTPServer((host, port), MockKismetHandler)
+    print(f"Mock Kismet REST API on http://{host}:{port}/ (Ctrl+C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Synthetic Kismet database generator and KismetParse benchmarks"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    generate_parser = subparsers.add_parser(
+        "generate", help="Write a synthetic Kismet database"
+    )
+    generate_parser.add_argument("output", help="Path of the .kismet file to write")
+    generate_parser.add_argument(
+        "-n",
+        "--devices",
+        type=int,
+        default=10000,
+        help="Number of devices (default: 10000)",
+    )
+    generate_parser.add_argument(
+        "--mix",
+        type=parse_mix,
+        default=DEFAULT_MIX,
+        help="Relative weight of each device kind, e.g. "
+        "btedr=1,btle_random=3,btle_named=2,client=3,ap=1,sensor=0.2 "
+        "(kinds left out are not generated)",
+    )
+    generate_parser.add_argument(
+        "--seed", type=int, default=0, help="Random seed (default: 0)"
+    )
+    generate_parser.add_argument(
+        "--packets",
+        type=int,
+        default=2,
+        help="Packets stored per device (default: 2)",
+    )
+
+    run_parser = subparsers.add_parser(
+        "run", help="Time each KismetParse stage at several database sizes"
+    )
+    run_parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=DEFAULT_SIZES,
+        help=f"Device counts to benchmark (default: {' '.join(map(str, DEFAULT_SIZES))})",
+    )
+    run_parser.add_argument(
+        "--workdir",
+        help="Directory for the generated databases, reused between runs "
+        "(default: a temporary directory)",
+    )
+    run_parser.add_argument(
+        "--mix", type=parse_mix, default=DEFAULT_MIX, help="Device mix, as for generate"
+    )
+    run_parser.add_argument(
+        "--seed", type=int, default=0, help="Random seed (default: 0)"
+    )
+    run_parser.add_argument(
+        "--stages",
+        nargs="+",
+        choices=BENCH_STAGES,
+        default=BENCH_STAGES,
+        help="Stages to report (default: all)",
+    )
+    run_parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="Timed runs per stage; the fastest is reported (default: 3)",
+    )
+    run_parser.add_argument(
+        "--no-memory",
+        action="store_true",
+        help="Skip the tracemalloc pass that measures peak memory",
+    )
+    run_parser.add_argument(
+        "-o", "--output", help="Write the results to this JSON file"
+    )
+    run_parser.add_argument(
+        "--compare",
+        metavar="RESULTS_JSON",
+        help="Fail if any stage is slower than in these earlier results",
+    )
+    run_parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Allowed slowdown for --compare as a fraction (default: 0.2)",
+    )
+
+    serve_parser = subparsers.add_parser(
+        "serve", help="Run a mock Kismet REST API for testing KismetParse --push"
+    )
+    serve_parser.add_argument(
+        "--host", default="127.0.0.1", help="Address to listen on (default: 127.0.0.1)"
+    )
+    serve_parser.add_argument(
+        "--port", type=int, default=2501, help="Port to listen on (default: 2501)"
+    )
+    serve_parser.add_argument(
+        "--no-list",
+        action="store_true",
+        help="Answer the target list endpoint with 404, like older Kismet releases",
+    )
+
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        serve_mock_kismet(args.host, args.port, list_endpoint=not args.no_list)
+        return
+
+    if args.command == "generate":
+        generate_database(args.output, args.devices, args.mix, args.seed, args.packets)
+        print(f"\033[32mWrote {args.devices} devices to {args.output}\033[0m")
+        return
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="kismetbench-")
+    os.makedirs(workdir, exist_ok=True)
+    print(f"{'devices':>9} {'stage':<28} {'time':>11} {'peak memory':>13}")
+    results = {}
+    for size in args.sizes:
+        results[str(size)] = benchmark_size(
+            workdir,
+            size,
+            args.mix,
+            args.seed,
+            memory=not args.no_memory,
+            stages=args.stages,
+            repeat=max(args.repeat, 1),
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {"python": sys.version.split()[0], "results": results}, f, indent=2
+            )
+        print(f"Results written to {args.output}")
+
+    if args.compare:
+        try:
+            with open(args.compare, "r") as f:
+                previous = json.load(f)["results"]
+        except (OSError, ValueError, KeyError) as e:
+            print(f"\033[31mError reading {args.compare}: {e}\033[0m")
+            sys.exit(1)
+        regressions = compare_results(results, previous, args.tolerance)
+        for size, stage, before, after in regressions:
+            print(
+                f"\033[31mRegression: {stage} at {size} devices took {after:.3f}s "
+                f"(was {before:.3f}s)\033[0m"
+            )
+        if regressions:
+            sys.exit(1)
+        print("\033[32mNo regressions\033[0m")
+
+
+if __name__ == "__main__":
+    main()
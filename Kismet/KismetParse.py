@@ -2,11 +2,419 @@ import sqlite3
 import json
 import sys
 import os
+import re
 import subprocess
 import argparse
-import shutil
+import csv
+import fnmatch
+import glob
+import asyncio
+import hashlib
+import heapq
+import math
+import struct
+import time
+import zlib
+import base64
+import http.client
+import urllib.parse
+import cProfile
+import functools
+import resource
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from array import array
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor
+from itertools import accumulate, chain
+from pathlib import Path
 from sqlite3 import Error
 
+# Number of device rows pulled from SQLite per fetchmany() call
+FETCH_BATCH_SIZE = 1000
+
+# Memory map and page cache of read-only capture connections, in bytes/KiB
+READ_MMAP_SIZE = 256 * 1024 * 1024
+READ_CACHE_KIB = 64 * 1024
+
+# First SQLite release that caches parsed JSON between json_extract calls on
+# the same blob; older builds re-parse it for every projected field, which
+# makes json1 extraction slower than decoding each device once in Python
+JSON1_FAST_SQLITE = (3, 45, 0)
+
+# Kismet device types that sort_devices_to_files can produce output for
+BTEDR_TYPES = ("BR/EDR",)
+BTLE_TYPES = ("BTLE",)
+WIFI_CLIENT_TYPES = ("Wi-Fi Client", "Wi-Fi Ad-Hoc", "Wi-Fi Device", "Wi-Fi Bridged")
+WIFI_AP_TYPES = ("Wi-Fi AP", "Wi-Fi WDS AP", "WiFi WDS")
+SENSOR_TYPES = ("Sensor",)
+TARGET_TYPES = (
+    BTEDR_TYPES + BTLE_TYPES + WIFI_CLIENT_TYPES + WIFI_AP_TYPES + SENSOR_TYPES
+)
+
+# Types classified from the devices table columns alone (no JSON needed)
+COLUMN_ONLY_TYPES = BTEDR_TYPES + SENSOR_TYPES
+
+# How device fields are pulled out of the JSON blobs: "json1" projects only
+# the fields we need inside SQLite, "full" decodes each blob with json.loads
+# and "auto" uses json1 whenever the SQLite build supports it
+EXTRACT_MODES = ("auto", "json1", "full")
+
+# JSON paths of the SSID maps unnested by the json1 projection
+PROBED_SSID_MAP = "dot11.device.probed_ssid_map"
+PROBED_SSID = "dot11.probedssid.ssid"
+ADVERTISED_SSID_MAP = "dot11.device.advertised_ssid_map"
+ADVERTISED_SSID = "dot11.advertisedssid.ssid"
+
+# On-disk cache of classified baseline/intersect databases
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+    "kismetparse",
+)
+CACHE_MAX_MB = 256
+CACHE_SUFFIX = ".kpc"
+CATEGORY_FILE_MAGIC = b"KPCATS\x00\x00"
+CATEGORY_FILE_VERSION = 2
+# Bytes hashed from the head and tail of a database to fingerprint it
+FINGERPRINT_BYTES = 64 * 1024
+
+# Kismet configuration directories that may hold kismet_alerts.conf
+KISMET_CONFIG_DIRS = ["/etc/kismet", "/usr/local/etc"]
+TARGET_ALERTS_CONF = "kismet_target_alerts.conf"
+
+# --watch timing, in seconds
+WATCH_DEBOUNCE = 2.0
+WATCH_POLL_INTERVAL = 1.0
+
+# Kismet REST API used to push device alerts to a running server
+PUSH_ADD_PATH = "/devices/alerts/mac/found/add.cmd"
+PUSH_REMOVE_PATH = "/devices/alerts/mac/found/remove.cmd"
+PUSH_LIST_PATH = "/devices/alerts/mac/found/macs.json"
+PUSH_BATCH_SIZE = 500
+PUSH_STATE_FILE = os.path.join(CACHE_DIR, "pushed_targets.json")
+
+# Source rowids copied per INSERT ... SELECT when pruning cleaned databases
+PRUNE_BATCH_ROWS = 100000
+
+# Index built on cleaned databases for --since/--until/--min-signal
+WINDOW_INDEX = "devices_window"
+
+# Incremental mode state file, stored next to the database by default
+STATE_SUFFIX = ".kpstate"
+
+# Target set exchange files (--export), accepted by -b/-i
+EXCHANGE_MAGIC = b"KPXCHG\x00\x00"
+EXCHANGE_VERSION = 1
+EXCHANGE_SUFFIX = ".kpx"
+
+# One address line of `ubertooth-rx -z` survey output, unknown octets as ??
+SURVEY_LINE = re.compile(r"^([0-9A-Fa-f]{2}|\?\?)(:([0-9A-Fa-f]{2}|\?\?)){5}$")
+SURVEY_UAP_SUFFIX = "_UAP"
+SURVEY_LAP_SUFFIX = "_LAP"
+SURVEY_HITS_SUFFIX = "_HITS.csv"
+SURVEY_RESOLVED_SUFFIX = "_RESOLVED.csv"
+# Bluetooth addresses are NAP(16):UAP(8):LAP(24) bits
+LAP_MASK = 0xFFFFFF
+UAP_LAP_MASK = 0xFFFFFFFF
+
+# Per-target record fields written by --records (after category and target)
+RECORD_FIELDS = (
+    "devkey",
+    "manuf",
+    "commonname",
+    "first_time",
+    "last_time",
+    "strongest_signal",
+    "packets",
+)
+RECORD_FORMATS = {
+    ".jsonl": "jsonl",
+    ".ndjson": "jsonl",
+    ".sqlite": "sqlite",
+    ".sqlite3": "sqlite",
+    ".db": "sqlite",
+}
+MAX_SIGNAL = "kismet.common.signal.max_signal"
+# Device fields the RECORD_FIELDS are read from, besides the device key
+METADATA_KEYS = (
+    "kismet.device.base.manuf",
+    "kismet.device.base.commonname",
+    "kismet.device.base.first_time",
+    "kismet.device.base.last_time",
+    "kismet.device.base.signal",
+    "kismet.device.base.packets.total",
+)
+
+# --max-targets/--target-quota relevance score: one point per doubling of
+# the packets seen, minus one per RANK_RECENCY_HOURS before the newest
+# target, plus one per RANK_SIGNAL_DB above RANK_SIGNAL_FLOOR, plus
+# RANK_NAMED_BONUS for devices with a name or known manufacturer. An SSID
+# scores the mean of its devices' scores plus one point per doubling of the
+# devices seen with it, not the best packets, signal and name among them
+RANK_RECENCY_HOURS = 6
+RANK_SIGNAL_DB = 10
+RANK_SIGNAL_FLOOR = -100
+RANK_NAMED_BONUS = 2.0
+# Categories that -e turns into Kismet alert entries, and so count towards
+# --max-targets; -a also reads SSID.txt, adding the advertised SSIDs
+ALERT_CATEGORIES = ("btedr", "btle", "client", "ap", "sensor", "probed_ssids")
+FILE_ALERT_CATEGORIES = (
+    "btedr",
+    "btle",
+    "client",
+    "ap",
+    "sensor",
+    "advertised_ssids",
+    "probed_ssids",
+)
+
+# -b/-i references of the form store:FILE[#CAPTURE,...] query a target store
+STORE_PREFIX = "store:"
+
+# Category names, in the order of ClassificationResult.categories
+CATEGORY_NAMES = (
+    "btedr",
+    "btle",
+    "client",
+    "ap",
+    "sensor",
+    "advertised_ssids",
+    "probed_ssids",
+)
+
+
+class NullStats:
+    """Stats collector used when --stats is off: every hook is a no-op"""
+
+    enabled = False
+
+    def stage(self, name):
+        return nullcontext()
+
+    def profile(self, name):
+        return nullcontext()
+
+    def count(self, name, value=1):
+        pass
+
+    def categories(self, label, result):
+        pass
+
+    def take_counters(self):
+        return {}
+
+    def merge(self, counters):
+        pass
+
+
+class RunStats(NullStats):
+    """
+    Per-stage wall/CPU time, throughput, bytes read, JSON errors and peak RSS
+    for --stats. Counters go to the stage that is running when they are
+    recorded; worker processes send theirs back through counted_call.
+    """
+
+    enabled = True
+
+    def __init__(self, profile_dir=None):
+        self.profile_dir = profile_dir
+        self.profiles = 0
+        self.reset()
+
+    def reset(self):
+        self.stages = []
+        self.category_counts = {}
+        self.counters = {}
+
+    @contextmanager
+    def stage(self, name):
+        self.counters = {}
+        wall = time.perf_counter()
+        cpu = time.process_time() + children_cpu_time()
+        bytes_read = read_io_bytes()
+        try:
+            yield
+        finally:
+            entry = {
+                "stage": name,
+                "wall_s": time.perf_counter() - wall,
+                "cpu_s": time.process_time() + children_cpu_time() - cpu,
+            }
+            if bytes_read is not None:
+                entry["bytes_read"] = read_io_bytes() - bytes_read
+            entry.update(self.take_counters())
+            if "devices" in entry and entry["wall_s"] > 0:
+                entry["devices_per_s"] = entry["devices"] / entry["wall_s"]
+            entry["peak_rss_kib"] = peak_rss_kib()
+            self.stages.append(
+                {
+                    key: round(value, 6) if isinstance(value, float) else value
+                    for key, value in entry.items()
+                }
+            )
+
+    @contextmanager
+    def profile(self, name):
+        if not self.profile_dir:
+            yield
+            return
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            self.profiles += 1
+            os.makedirs(self.profile_dir, exist_ok=True)
+            path = os.path.join(
+                self.profile_dir, f"{name}-{os.getpid()}-{self.profiles}.prof"
+            )
+            profiler.dump_stats(path)
+            print(f"Profile of {name} written to {path}")
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def categories(self, label, result):
+        self.category_counts[label] = {
+            name: len(values) for name, values in zip(CATEGORY_NAMES, result.categories)
+        }
+
+    def take_counters(self):
+        counters, self.counters = self.counters, {}
+        return counters
+
+    def merge(self, counters):
+        for name, value in counters.items():
+            self.count(name, value)
+
+    def as_dict(self):
+        return {"stages": self.stages, "categories": self.category_counts}
+
+    def print_report(self):
+        print("\nStage statistics:")
+        print(
+            f"{'stage':<18}{'wall s':>9}{'cpu s':>9}{'read s':>9}{'decode s':>9}"
+            f"{'devices':>10}{'dev/s':>10}{'MiB read':>10}{'errors':>8}"
+            f"{'peak RSS MiB':>14}"
+        )
+        for entry in self.stages:
+            bytes_read = entry.get("bytes_read")
+            print(
+                f"{entry['stage']:<18}{entry['wall_s']:>9.3f}{entry['cpu_s']:>9.3f}"
+                f"{entry.get('sqlite_read_s', 0):>9.3f}"
+                f"{entry.get('json_decode_s', 0):>9.3f}"
+                f"{entry.get('devices', 0):>10}"
+                f"{entry.get('devices_per_s', 0):>10.0f}"
+                f"{bytes_read / 2**20 if bytes_read is not None else 0:>10.1f}"
+                f"{entry.get('json_errors', 0):>8}"
+                f"{entry['peak_rss_kib'] / 1024:>14.1f}"
+            )
+        for label, counts in self.category_counts.items():
+            summary = ", ".join(f"{name} {count}" for name, count in counts.items())
+            print(f"Devices per category ({label}): {summary}")
+
+
+def children_cpu_time():
+    """CPU seconds used by reaped child processes (pool workers)"""
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def peak_rss_kib():
+    """Peak resident set size of this process or any reaped child, in KiB"""
+    return max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+
+
+def read_io_bytes():
+    """Bytes this process has read through read() calls, or None if unknown"""
+    try:
+        with open("/proc/self/io", "r") as f:
+            for line in f:
+                if line.startswith("rchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def read_mmap_size():
+    """
+    Memory map size for capture reads. Mapping is turned off under --stats:
+    mapped pages never pass through read(), so bytes read would miss them,
+    and they would count toward peak RSS.
+    """
+    return 0 if STATS.enabled else READ_MMAP_SIZE
+
+
+def counted_call(func, *args):
+    """
+    Worker process entry point under --stats: run func and return its result
+    together with the counters (and bytes read) it recorded, for the parent
+    to merge into the running stage.
+    """
+    STATS.take_counters()
+    bytes_read = read_io_bytes()
+    result = func(*args)
+    if bytes_read is not None:
+        STATS.count("bytes_read", read_io_bytes() - bytes_read)
+    return result, STATS.take_counters()
+
+
+def map_counted(pool, func, *iterables):
+    """pool.map(func, ...) that also merges worker counters when stats are on"""
+    if not STATS.enabled:
+        return list(pool.map(func, *iterables))
+    results = []
+    for result, counters in pool.map(
+        counted_call, *([func] * len(iterables[0]),) + iterables
+    ):
+        STATS.merge(counters)
+        results.append(result)
+    return results
+
+
+def profiled(func):
+    """Run func under cProfile when --profile is given"""
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with STATS.profile(func.__name__):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+# Replaced by a RunStats in main() when --stats, --stats-json or --profile is set
+STATS = NullStats()
+
+# Set by --immutable for captures Kismet has finished writing
+IMMUTABLE_CAPTURES = False
+
+
+def mac_to_int(mac):
+    """Encode a colon-separated MAC address as a 48-bit integer (None if invalid)"""
+    if len(mac) != 17:
+        return None
+    try:
+        return int(mac.replace(":", ""), 16)
+    except ValueError:
+        return None
+
+
+def int_to_mac(value):
+    """Format a 48-bit integer as an upper-case colon-separated MAC address"""
+    digits = f"{value:012X}"
+    return ":".join(digits[i : i + 2] for i in range(0, 12, 2))
+
+
+def mac_array(values=()):
+    """Compact array of MAC integers (8 bytes each)"""
+    return array("Q", values)
+
 
 def create_connection(db_file):
     """Create a database connection to the SQLite database specified by db_file"""
@@ -15,7 +423,7 @@ def create_connection(db_file):
         sys.exit(1)
     conn = None
     try:
-        conn = sqlite3.connect(db_file)
+        conn = open_read_only(db_file)
         print(f"Successfully connected to {db_file}")
         return conn
     except Error as e:
@@ -23,29 +431,521 @@ def create_connection(db_file):
     return conn
 
 
-def extract_devices_json(conn):
-    """Extract JSON data from the 'devices' table"""
+def capture_uri(db_file):
+    """
+    Read-only URI of a capture; with --immutable SQLite also skips locking
+    and change detection, which is only safe once Kismet has closed it
+    """
+    uri = f"{Path(db_file).resolve().as_uri()}?mode=ro"
+    return f"{uri}&immutable=1" if IMMUTABLE_CAPTURES else uri
+
+
+def open_read_only(db_file):
+    """
+    Open a capture for reading without ever taking a write lock. Reads that
+    must agree with each other go through read_snapshot().
+    """
+    conn = sqlite3.connect(capture_uri(db_file), uri=True)
+    conn.execute("PRAGMA query_only=ON")
+    conn.execute(f"PRAGMA mmap_size={read_mmap_size()}")
+    conn.execute(f"PRAGMA cache_size=-{READ_CACHE_KIB}")
+    return conn
+
+
+@contextmanager
+def read_snapshot(conn):
+    """
+    Run the reads of the block from one snapshot, then end the read
+    transaction so the connection holds no lock (and sees new rows) while
+    idle. With a rollback journal Kismet's commits still wait for the block
+    to finish; only WAL captures can be written to during it.
+    """
+    if conn.in_transaction:
+        yield conn
+        return
+    conn.execute("BEGIN")
+    try:
+        yield conn
+    finally:
+        conn.commit()
+
+
+def fetch_row_batches(cursor, batch_size=FETCH_BATCH_SIZE):
+    """Yield lists of rows from an executed cursor, one per fetchmany() call"""
+    while True:
+        started = time.perf_counter()
+        try:
+            rows = cursor.fetchmany(batch_size)
+        except Error as e:
+            print("Error querying 'devices' table:", e)
+            return
+        STATS.count("sqlite_read_s", time.perf_counter() - started)
+        if not rows:
+            return
+        yield rows
+
+
+def fetch_batches(cursor, batch_size=FETCH_BATCH_SIZE):
+    """Yield rows from an executed cursor, fetchmany() batch by batch"""
+    for rows in fetch_row_batches(cursor, batch_size):
+        yield from rows
+
+
+def decode_device(blob):
+    """Decode one device JSON blob, returning None if it is malformed"""
+    try:
+        return json.loads(blob)
+    except json.JSONDecodeError:
+        STATS.count("json_errors")
+        print(
+            f"Error decoding JSON for device: {blob[:50]}..."
+        )  # Print first 50 chars of problematic data
+        return None
+
+
+def decode_device_timed(blob):
+    """decode_device() that adds its time to the --stats JSON decode total"""
+    started = time.perf_counter()
+    device_json = decode_device(blob)
+    STATS.count("json_decode_s", time.perf_counter() - started)
+    return device_json
+
+
+def device_filter(rowid_range=None, since_rowid=None, window=None):
+    """
+    Build the extra WHERE conditions that limit which device rows are read.
+    window is a (since, until, min_signal) tuple from device_window(); its
+    bounds are checked against the devices table columns, so rows outside
+    it are never decoded. Returns (conditions, params); an empty filter
+    reads the whole table.
+    """
+    conditions = []
+    params = []
+    if rowid_range is not None:
+        conditions.append("rowid BETWEEN ? AND ?")
+        params.extend(rowid_range)
+    if since_rowid is not None:
+        conditions.append("rowid >= ?")
+        params.append(since_rowid)
+    if window is not None:
+        since, until, min_signal = window
+        # A device is in the window if it was seen at any time during it
+        if since is not None:
+            conditions.append("last_time >= ?")
+            params.append(since)
+        if until is not None:
+            conditions.append("first_time <= ?")
+            params.append(until)
+        if min_signal is not None:
+            # Kismet stores 0 for devices it has no signal reading for
+            conditions.append("strongest_signal >= ? AND strongest_signal != 0")
+            params.append(min_signal)
+    return conditions, tuple(params)
+
+
+def device_window(since=None, until=None, min_signal=None):
+    """Bundle the --since/--until/--min-signal filters (None if none are set)"""
+    if since is None and until is None and min_signal is None:
+        return None
+    return since, until, min_signal
+
+
+def parse_time(value):
+    """argparse type for --since/--until: Unix seconds or an ISO 8601 local time"""
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        return int(datetime.fromisoformat(value).timestamp())
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"invalid time {value!r}, expected Unix seconds or YYYY-MM-DD[ HH:MM[:SS]]"
+        )
+
+
+def filter_sql(filters, prefix):
+    """Render device_filter() conditions as a SQL fragment starting with prefix"""
+    conditions, params = filters if filters else ((), ())
+    if not conditions:
+        return "", ()
+    return f" {prefix} " + " AND ".join(conditions), params
+
+
+def iter_devices_json(conn, batch_size=FETCH_BATCH_SIZE, filters=None):
+    """Stream decoded device JSON from the 'devices' table in fetchmany batches"""
+    where, params = filter_sql(filters, "WHERE")
     try:
         cursor = conn.cursor()
-        cursor.execute("SELECT device FROM devices")
-        rows = cursor.fetchall()
+        cursor.execute(f"SELECT device FROM devices{where}", params)
+    except Error as e:
+        print("Error querying 'devices' table:", e)
+        return
 
-        devices_list = []
-        for row in rows:
-            try:
-                device_json = json.loads(row[0])
-                devices_list.append(device_json)
-            except json.JSONDecodeError:
-                print(
-                    f"Error decoding JSON for device: {row[0][:50]}..."
-                )  # Print first 50 chars of problematic data
+    decode = decode_device_timed if STATS.enabled else decode_device
+    decoded = 0
+    for row in fetch_batches(cursor, batch_size):
+        device_json = decode(row[0])
+        if device_json is None:
+            continue
+        decoded += 1
+        yield device_json
 
-        print(f"\nExtracted JSON data for {len(devices_list)} devices")
-        return devices_list
+    STATS.count("devices", decoded)
+    print(f"\nExtracted JSON data for {decoded} devices")
 
+
+def has_device_columns(conn):
+    """Check the devices table has the columns the query planner relies on"""
+    try:
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(devices)")}
     except Error as e:
         print("Error querying 'devices' table:", e)
-        return []
+        return False
+    return {"type", "devmac", "devkey", "device"} <= columns
+
+
+def has_json1(conn):
+    """Check whether this SQLite build provides the JSON1 functions"""
+    try:
+        conn.execute("SELECT json_extract('{\"a\": 1}', '$.a')").fetchone()
+        return True
+    except Error:
+        return False
+
+
+def placeholders(values):
+    """Return a '?,?,...' placeholder list for an IN clause over values"""
+    return ",".join("?" for _ in values)
+
+
+def plan_device_query(conn, filters=None, metadata=False):
+    """
+    Build the devices query with the type filter pushed down into SQLite.
+    Rows whose type can never produce output are not selected at all, and
+    the device blob is only selected for types that need JSON fields (all
+    of them when per-target metadata is wanted).
+    Returns (sql, params), or None if the table lacks the needed columns.
+    """
+    if not has_device_columns(conn):
+        return None
+
+    where, where_params = filter_sql(filters, "AND")
+    if metadata:
+        sql = (
+            "SELECT type, devmac, devkey, device "
+            f"FROM devices WHERE type IN ({placeholders(TARGET_TYPES)}){where}"
+        )
+        return sql, TARGET_TYPES + where_params
+    sql = (
+        "SELECT type, devmac, devkey, "
+        f"CASE WHEN type IN ({placeholders(COLUMN_ONLY_TYPES)}) "
+        "THEN NULL ELSE device END "
+        f"FROM devices WHERE type IN ({placeholders(TARGET_TYPES)}){where}"
+    )
+    return sql, COLUMN_ONLY_TYPES + TARGET_TYPES + where_params
+
+
+def plan_projection_query(conn, filters=None, metadata=False):
+    """
+    Build a JSON1 query that projects only the device fields the classifier
+    reads, with the probed/advertised SSID maps unnested into one row per
+    SSID by json_each. Rows come out ordered by device rowid; rows with
+    malformed JSON carry the first 50 characters of the blob instead.
+    With metadata the first/last time and strongest signal are projected as
+    well, and column-only types are read from JSON like the others.
+    Returns (sql, params), or None if the table lacks the needed columns.
+    """
+    if not has_device_columns(conn):
+        return None
+
+    column_only = () if metadata else COLUMN_ONLY_TYPES
+    skip_json = (
+        f"CASE WHEN type IN ({placeholders(column_only)}) "
+        "THEN NULL ELSE CAST(device AS TEXT) END"
+        if column_only
+        else "CAST(device AS TEXT)"
+    )
+    if metadata:
+        metadata_columns = (
+            "json_extract(c.j, '$.\"kismet.device.base.first_time\"'), "
+            "json_extract(c.j, '$.\"kismet.device.base.last_time\"'), "
+            "json_extract(c.j, "
+            f'\'$."kismet.device.base.signal"."{MAX_SIGNAL}"\'), '
+            "json_extract(c.j, '$.\"kismet.device.base.packets.total\"'), "
+        )
+    else:
+        metadata_columns = "NULL, NULL, NULL, NULL, "
+
+    where, where_params = filter_sql(filters, "AND")
+    # Only arrays are unnested, matching how the full decode walks the maps
+    ssid_map = (
+        f"CASE WHEN type IN ({placeholders(WIFI_CLIENT_TYPES)}) "
+        f'THEN \'$."dot11.device"."{PROBED_SSID_MAP}"\' '
+        f"WHEN type IN ({placeholders(WIFI_AP_TYPES)}) "
+        f'THEN \'$."dot11.device"."{ADVERTISED_SSID_MAP}"\' END'
+    )
+    sql = (
+        "WITH raw AS ("
+        "SELECT rowid AS rid, type, devmac, devkey, "
+        f"{skip_json} AS j "
+        f"FROM devices WHERE type IN ({placeholders(TARGET_TYPES)}){where}"
+        "), checked AS ("
+        "SELECT rid, type, devmac, devkey, "
+        "CASE WHEN json_valid(j) THEN j END AS j, "
+        "CASE WHEN j IS NOT NULL AND NOT json_valid(j) "
+        "THEN substr(j, 1, 50) END AS bad, "
+        f"{ssid_map} AS map_path "
+        "FROM raw"
+        ") "
+        "SELECT c.rid, c.type, c.devmac, c.devkey, c.bad, "
+        "json_extract(c.j, '$.\"kismet.device.base.type\"'), "
+        "json_extract(c.j, '$.\"kismet.device.base.macaddr\"'), "
+        "json_extract(c.j, '$.\"kismet.device.base.key\"'), "
+        "json_extract(c.j, '$.\"kismet.device.base.commonname\"'), "
+        "json_extract(c.j, '$.\"kismet.device.base.manuf\"'), "
+        f"{metadata_columns}"
+        "s.key, "
+        "CASE WHEN s.type = 'object' THEN json_extract(s.value, "
+        f"'$.\"{PROBED_SSID}\"') END, "
+        "CASE WHEN s.type = 'object' THEN json_extract(s.value, "
+        f"'$.\"{ADVERTISED_SSID}\"') END "
+        "FROM checked AS c LEFT JOIN json_each("
+        "CASE WHEN json_type(c.j, c.map_path) = 'array' "
+        "THEN json_extract(c.j, c.map_path) END) AS s "
+        "ORDER BY c.rid"
+    )
+    params = (
+        column_only + TARGET_TYPES + where_params + WIFI_CLIENT_TYPES + WIFI_AP_TYPES
+    )
+    return sql, params
+
+
+def column_device(dev_type, mac, device_key):
+    """Build a minimal device record from the devices table columns"""
+    return {
+        "kismet.device.base.type": dev_type,
+        "kismet.device.base.macaddr": mac,
+        "kismet.device.base.key": device_key,
+    }
+
+
+def add_device_metadata(device, source):
+    """Copy the fields --records reports from a decoded device onto device"""
+    if isinstance(source, dict):
+        for key in METADATA_KEYS:
+            if key in source:
+                device[key] = source[key]
+    return device
+
+
+def projected_device(
+    dev_type,
+    mac,
+    device_key,
+    commonname,
+    manuf,
+    first_time,
+    last_time,
+    signal,
+    packets,
+):
+    """Build a device record from the fields projected by plan_projection_query"""
+    device = {
+        "kismet.device.base.type": dev_type,
+        "kismet.device.base.macaddr": mac,
+        "kismet.device.base.key": device_key,
+        "kismet.device.base.commonname": commonname,
+        "kismet.device.base.manuf": manuf,
+    }
+    if first_time is not None or last_time is not None or signal is not None:
+        device["kismet.device.base.first_time"] = first_time
+        device["kismet.device.base.last_time"] = last_time
+        device["kismet.device.base.signal"] = {MAX_SIGNAL: signal}
+    if packets is not None:
+        device["kismet.device.base.packets.total"] = packets
+    return device
+
+
+def iter_projected_devices(cursor, batch_size=FETCH_BATCH_SIZE):
+    """Regroup the rows of a projection query into one record per device"""
+    device = None
+    current = None
+    for (
+        rid,
+        column_type,
+        devmac,
+        devkey,
+        bad,
+        dev_type,
+        mac,
+        device_key,
+        commonname,
+        manuf,
+        first_time,
+        last_time,
+        signal,
+        packets,
+        ssid_index,
+        probed_ssid,
+        advertised_ssid,
+    ) in fetch_batches(cursor, batch_size):
+        if rid != current:
+            if device is not None:
+                yield device
+            current = rid
+            if column_type in COLUMN_ONLY_TYPES:
+                device = column_device(column_type, devmac, devkey)
+                if first_time is not None or last_time is not None:
+                    add_device_metadata(
+                        device,
+                        projected_device(
+                            dev_type,
+                            mac,
+                            device_key,
+                            commonname,
+                            manuf,
+                            first_time,
+                            last_time,
+                            signal,
+                            packets,
+                        ),
+                    )
+            elif bad is not None:
+                STATS.count("json_errors")
+                print(f"Error decoding JSON for device: {bad}...")
+                device = None
+            else:
+                device = projected_device(
+                    dev_type,
+                    mac,
+                    device_key,
+                    commonname,
+                    manuf,
+                    first_time,
+                    last_time,
+                    signal,
+                    packets,
+                )
+
+        if device is None or ssid_index is None:
+            continue
+
+        # Rebuild just the SSID map the classifier will walk for this device
+        if column_type in WIFI_CLIENT_TYPES:
+            ssid_map = device.setdefault("dot11.device", {}).setdefault(
+                PROBED_SSID_MAP, []
+            )
+            ssid_map.append({PROBED_SSID: probed_ssid})
+        else:
+            ssid_map = device.setdefault("dot11.device", {}).setdefault(
+                ADVERTISED_SSID_MAP, []
+            )
+            ssid_map.append({ADVERTISED_SSID: advertised_ssid})
+
+    if device is not None:
+        yield device
+
+
+def choose_extract_mode(conn, mode="auto"):
+    """
+    Resolve the requested extraction mode against this SQLite build. auto
+    only picks json1 where SQLite caches parsed JSON (3.45 and later).
+    """
+    if mode == "full":
+        return "full"
+    if mode == "auto" and sqlite3.sqlite_version_info < JSON1_FAST_SQLITE:
+        return "full"
+    if has_json1(conn):
+        return "json1"
+    if mode == "json1":
+        print(
+            "\033[31mError: SQLite build has no JSON1 support for --extract json1\033[0m"
+        )
+        sys.exit(1)
+    return "full"
+
+
+def iter_devices(
+    conn, batch_size=FETCH_BATCH_SIZE, mode="auto", filters=None, metadata=False
+):
+    """
+    Stream the devices sort_devices_to_files needs, decoding JSON only for
+    rows whose type requires it (every row with metadata). In json1 mode
+    only the needed fields are projected out of each blob by SQLite; in full
+    mode each blob is decoded with json.loads. Falls back to a full decode of
+    every row when the devices table has no usable type column.
+    """
+    mode = choose_extract_mode(conn, mode)
+    if mode == "json1":
+        plan = plan_projection_query(conn, filters, metadata)
+    else:
+        plan = plan_device_query(conn, filters, metadata)
+    if plan is None:
+        yield from iter_devices_json(conn, batch_size, filters)
+        return
+
+    sql, params = plan
+    try:
+        cursor = conn.cursor()
+        cursor.execute(sql, params)
+    except Error as e:
+        print("Error querying 'devices' table:", e)
+        return
+
+    if mode == "json1":
+        extracted = 0
+        for device in iter_projected_devices(cursor, batch_size):
+            extracted += 1
+            yield device
+        STATS.count("devices", extracted)
+        print(f"\nExtracted {extracted} devices (JSON1 field projection)")
+        return
+
+    decode = decode_device_timed if STATS.enabled else decode_device
+    from_columns = 0
+    decoded = 0
+    for dev_type, mac, device_key, blob in fetch_batches(cursor, batch_size):
+        if blob is None:
+            from_columns += 1
+            yield column_device(dev_type, mac, device_key)
+            continue
+        if dev_type in COLUMN_ONLY_TYPES:
+            # Only selected for metadata; classification still uses the columns
+            from_columns += 1
+            device = column_device(dev_type, mac, device_key)
+            try:
+                yield add_device_metadata(device, json.loads(blob))
+            except (json.JSONDecodeError, TypeError):
+                yield device
+            continue
+        device_json = decode(blob)
+        if device_json is None:
+            continue
+        decoded += 1
+        yield device_json
+
+    STATS.count("devices", from_columns + decoded)
+    print(
+        f"\nExtracted {from_columns + decoded} devices "
+        f"({decoded} decoded from JSON, {from_columns} from table columns)"
+    )
+
+
+def extract_devices_json(conn):
+    """Extract JSON data from the 'devices' table"""
+    return list(iter_devices_json(conn))
+
+
+def target_lines(values):
+    """
+    Unique targets in sorted order as strings. MAC integers are formatted as
+    colon-hex here, at write time; sorted arrays from the classifier are
+    already unique, anything else is deduplicated first.
+    """
+    if not isinstance(values, array):
+        values = sorted({value for value in values if value is not None})
+    return [int_to_mac(value) if isinstance(value, int) else value for value in values]
 
 
 def generate_intermediate_files(
@@ -60,39 +960,76 @@ def generate_intermediate_files(
     """Generate intermediate files like KismetParse.py does"""
     # Write files with unique entries
     with open("BTEDR.txt", "w") as f:
-        f.write("\n".join(set(btedr_macs)))
+        f.write("\n".join(target_lines(btedr_macs)))
 
     with open("BTLE.txt", "w") as f:
-        f.write("\n".join(set(btle_macs)))
+        f.write("\n".join(target_lines(btle_macs)))
 
     with open("CLIENT.txt", "w") as f:
-        f.write("\n".join(set(client_macs)))
+        f.write("\n".join(target_lines(client_macs)))
 
     with open("SSID.txt", "w") as f:
-        f.write("\n".join(set(advertised_ssids)))
+        f.write("\n".join(target_lines(advertised_ssids)))
 
     with open("ProbedSSID.txt", "w") as f:
-        f.write("\n".join(set(probed_ssids)))
+        f.write("\n".join(target_lines(probed_ssids)))
 
     with open("AP.txt", "w") as f:
-        f.write("\n".join(set(ap_macs)))
+        f.write("\n".join(target_lines(ap_macs)))
 
     with open("SENSORS.txt", "w") as f:
-        f.write("\n".join(set(sensor_macs)))
+        f.write("\n".join(target_lines(sensor_macs)))
 
     print("Intermediate files created with extracted SSIDs and MAC addresses")
 
 
-def generate_target_alerts_from_files():
-    """Generate Kismet target alert configuration from existing files (add_targets.sh functionality)"""
-    config_dirs = ["/etc/kismet", "/usr/local/etc"]
-    mac_sources = ["AP.txt", "BTEDR.txt", "BTLE.txt", "CLIENT.txt", "SENSORS.txt"]
-    ssid_sources = ["SSID.txt", "ProbedSSID.txt"]
+def render_target_alerts(ssids, macs):
+    """
+    Render the target alert configuration once, in sorted order: one
+    ssidcanary line per unique SSID followed by one devicefound line per
+    unique MAC address. SSIDs are used exactly as given, since leading or
+    trailing spaces are part of the network name; only empty ones are
+    dropped.
+    """
+    lines = [f'ssidcanary="{ssid}":ssid="{ssid}"' for ssid in sorted(set(ssids) - {""})]
+    lines.extend(
+        f"devicefound={mac}"
+        for mac in sorted({mac.strip().replace("-", "") for mac in macs} - {""})
+    )
+    return "".join(f"{line}\n" for line in lines)
+
+
+def write_file_atomically(path, content):
+    """Replace path with content via a temp file and rename, keeping its mode"""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(content)
+    if os.path.exists(path):
+        os.chmod(tmp_path, os.stat(path).st_mode & 0o7777)
+    os.replace(tmp_path, path)
+
+
+def write_if_changed(path, content):
+    """Atomically write content to path unless it already holds exactly that"""
+    if os.path.isfile(path):
+        with open(path, "r") as f:
+            if f.read() == content:
+                return False
+    write_file_atomically(path, content)
+    return True
+
+
+def install_target_alerts(content):
+    """
+    Write rendered target alerts to every Kismet configuration directory,
+    adding the include directive where missing. Unchanged files are left
+    untouched so Kismet only sees a change when the target set changed.
+    """
     processed_dirs = 0
 
-    for config_dir in config_dirs:
+    for config_dir in KISMET_CONFIG_DIRS:
         alerts_conf = os.path.join(config_dir, "kismet_alerts.conf")
-        target_conf = os.path.join(config_dir, "kismet_target_alerts.conf")
+        target_conf = os.path.join(config_dir, TARGET_ALERTS_CONF)
 
         # Verify config directory and alerts file exist
         if os.path.isdir(config_dir) and os.path.isfile(alerts_conf):
@@ -106,48 +1043,17 @@ def generate_target_alerts_from_files():
                 sys.exit(1)
 
             # Add include directive if missing
-            with open(alerts_conf, "r+") as f:
-                content = f.read()
-                if include_line not in content:
-                    f.write(f"\n{include_line}\n")
-
-            # Create fresh target file
-            with open(target_conf, "w") as f:
-                # Process SSIDs from all sources
-                for ssid_file in ssid_sources:
-                    if os.path.isfile(ssid_file):
-                        if not os.access(ssid_file, os.R_OK):
-                            print(
-                                f"\033[31mError: Cannot read SSID file: {ssid_file}\033[0m"
-                            )
-                            sys.exit(1)
-                        with open(ssid_file, "r") as sf:
-                            for line in sf:
-                                ssid = line.strip()
-                                if ssid:
-                                    f.write(f'ssidcanary="{ssid}":ssid="{ssid}"\n')
-                    else:
-                        print(
-                            f"\033[33mWarning: {ssid_file} not found - skipping SSID alerts\033[0m"
-                        )
+            with open(alerts_conf, "r") as f:
+                alerts_content = f.read()
+            if include_line not in alerts_content:
+                write_file_atomically(
+                    alerts_conf, f"{alerts_content}\n{include_line}\n"
+                )
 
-                # Process MAC addresses from all sources
-                for source in mac_sources:
-                    if os.path.isfile(source):
-                        if not os.access(source, os.R_OK):
-                            print(
-                                f"\033[31mError: Cannot read MAC source file: {source}\033[0m"
-                            )
-                            sys.exit(1)
-                        with open(source, "r") as sf:
-                            for line in sf:
-                                mac = line.strip().replace("-", "")
-                                if mac:
-                                    f.write(f"devicefound={mac}\n")
-                    else:
-                        print(f"\033[33mWarning: {source} not found - skipping\033[0m")
-
-            print(f"\033[32mConfiguration updated in {config_dir}\033[0m")
+            if write_if_changed(target_conf, content):
+                print(f"\033[32mConfiguration updated in {config_dir}\033[0m")
+            else:
+                print(f"\033[32mConfiguration unchanged in {config_dir}\033[0m")
             processed_dirs += 1
 
     if processed_dirs == 0:
@@ -155,6 +1061,44 @@ def generate_target_alerts_from_files():
         sys.exit(1)
 
 
+def read_target_file(path, kind):
+    """Read the non-empty lines of an intermediate file, or None if it is missing"""
+    if not os.path.isfile(path):
+        return None
+    if not os.access(path, os.R_OK):
+        print(f"\033[31mError: Cannot read {kind} file: {path}\033[0m")
+        sys.exit(1)
+    with open(path, "r") as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def generate_target_alerts_from_files():
+    """Generate Kismet target alert configuration from existing files (add_targets.sh functionality)"""
+    mac_sources = ["AP.txt", "BTEDR.txt", "BTLE.txt", "CLIENT.txt", "SENSORS.txt"]
+    ssid_sources = ["SSID.txt", "ProbedSSID.txt"]
+
+    # Every intermediate file is read once, whatever the number of config dirs
+    ssids = []
+    for ssid_file in ssid_sources:
+        lines = read_target_file(ssid_file, "SSID")
+        if lines is None:
+            print(
+                f"\033[33mWarning: {ssid_file} not found - skipping SSID alerts\033[0m"
+            )
+        else:
+            ssids.extend(lines)
+
+    macs = []
+    for source in mac_sources:
+        lines = read_target_file(source, "MAC source")
+        if lines is None:
+            print(f"\033[33mWarning: {source} not found - skipping\033[0m")
+        else:
+            macs.extend(lines)
+
+    install_target_alerts(render_target_alerts(ssids, macs))
+
+
 def clean_intermediate_files():
     """Clean up intermediate files"""
     files_to_clean = [
@@ -181,12 +1125,11 @@ def clean_intermediate_files():
 
 def delete_target_configuration():
     """Delete target configuration file and include statement from Kismet configuration"""
-    config_dirs = ["/etc/kismet", "/usr/local/etc"]
     processed_dirs = 0
 
-    for config_dir in config_dirs:
+    for config_dir in KISMET_CONFIG_DIRS:
         alerts_conf = os.path.join(config_dir, "kismet_alerts.conf")
-        target_conf = os.path.join(config_dir, "kismet_target_alerts.conf")
+        target_conf = os.path.join(config_dir, TARGET_ALERTS_CONF)
 
         # Verify config directory and alerts file exist
         if os.path.isdir(config_dir) and os.path.isfile(alerts_conf):
@@ -253,105 +1196,628 @@ def generate_target_alerts(
     btedr_macs, btle_macs, client_macs, ap_macs, sensor_macs, ssid_list
 ):
     """Generate Kismet target alert configuration from extracted data"""
-    config_dirs = ["/etc/kismet", "/usr/local/etc"]
-    target_config = "kismet_target_alerts.conf"
-    processed = False
+    macs = []
+    for mac_source in (btedr_macs, btle_macs, client_macs, ap_macs, sensor_macs):
+        macs.extend(target_lines(mac_source))
+    install_target_alerts(render_target_alerts(target_lines(ssid_list), macs))
+
+
+class KismetRestSession:
+    """Pooled keep-alive HTTP connection to the REST API of a running Kismet"""
+
+    def __init__(self, url, user=None, password=None, apikey=None, timeout=10):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            raise ValueError(f"Invalid Kismet URL: {url}")
+        self.url = url
+        self.scheme = parts.scheme
+        self.host = parts.hostname
+        self.port = parts.port
+        self.base_path = parts.path.rstrip("/")
+        self.timeout = timeout
+        self.headers = {
+            "Content-Type": "application/x-www-form-urlencoded",
+            "Connection": "keep-alive",
+        }
+        if user:
+            token = base64.b64encode(f"{user}:{password or ''}".encode()).decode()
+            self.headers["Authorization"] = f"Basic {token}"
+        if apikey:
+            self.headers["Cookie"] = f"KISMET={apikey}"
+        self.conn = None
+
+    def post(self, path, payload):
+        """POST a Kismet command"""
+        body = urllib.parse.urlencode({"json": json.dumps(payload)})
+        return self.request("POST", path, body)
+
+    def get_json(self, path):
+        """GET and decode a Kismet JSON endpoint"""
+        return json.loads(self.request("GET", path))
+
+    def request(self, method, path, body=None):
+        """Send one request, reconnecting once if the kept-alive socket died"""
+        for attempt in range(2):
+            if self.conn is None:
+                connection_class = (
+                    http.client.HTTPSConnection
+                    if self.scheme == "https"
+                    else http.client.HTTPConnection
+                )
+                self.conn = connection_class(self.host, self.port, timeout=self.timeout)
+            try:
+                self.conn.request(method, self.base_path + path, body, self.headers)
+                response = self.conn.getresponse()
+                data = response.read()
+            except (http.client.HTTPException, OSError):
+                self.close()
+                if attempt:
+                    raise
+                continue
+            if response.status >= 400:
+                raise http.client.HTTPException(
+                    f"{path} returned HTTP {response.status}: {data[:200]!r}"
+                )
+            return data
 
-    for config_dir in config_dirs:
-        alerts_conf = os.path.join(config_dir, "kismet_alerts.conf")
-        target_path = os.path.join(config_dir, target_config)
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
 
-        if os.path.isdir(config_dir) and os.path.isfile(alerts_conf):
-            # Verify alerts config file is readable
-            if not os.access(alerts_conf, os.R_OK):
-                print(
-                    f"\033[31mError: Cannot read alerts configuration file: {alerts_conf}\033[0m"
-                )
-                sys.exit(1)
 
-            include_line = f"opt_include={target_path}"
+def read_push_state(state_file, url):
+    """MAC addresses previously pushed to the Kismet server at url"""
+    try:
+        with open(state_file, "r") as f:
+            return set(json.load(f).get(url, []))
+    except (OSError, ValueError):
+        return set()
 
-            # Add include directive if missing
-            with open(alerts_conf, "r+") as f:
-                content = f.read()
-                if include_line not in content:
-                    f.write(f"\n{include_line}\n")
-
-            # Generate target configuration
-            with open(target_path, "w") as f:
-                # Write SSID alerts
-                for ssid in set(ssid_list):
-                    if ssid:
-                        f.write(f'ssidcanary="{ssid}":ssid="{ssid}"\n')
-
-                # Write MAC alerts
-                mac_sources = {
-                    "btedr": btedr_macs,
-                    "btle": btle_macs,
-                    "client": client_macs,
-                    "ap": ap_macs,
-                    "sensor": sensor_macs,
-                }
 
-                for mac_type, macs in mac_sources.items():
-                    for mac in set(macs):
-                        cleaned_mac = mac.strip().replace("-", "")
-                        if cleaned_mac:
-                            f.write(f"devicefound={cleaned_mac}\n")
+def write_push_state(state_file, url, macs):
+    """Record the MAC addresses now pushed to the Kismet server at url"""
+    try:
+        with open(state_file, "r") as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        state = {}
+    state[url] = sorted(macs)
+    os.makedirs(os.path.dirname(os.path.abspath(state_file)), exist_ok=True)
+    write_file_atomically(state_file, json.dumps(state))
 
-            print(f"\033[32mConfiguration updated in {config_dir}\033[0m")
-            processed = True
-            break
 
-    if not processed:
-        print("\033[31mError: No valid Kismet configuration directories found\033[0m")
-        sys.exit(1)
+def fetch_pushed_alerts(session):
+    """
+    The devicefound MAC addresses the Kismet server currently holds, or None
+    if it cannot list them (older Kismet releases have no list endpoint)
+    """
+    try:
+        macs = session.get_json(PUSH_LIST_PATH)
+    except (http.client.HTTPException, ValueError) as e:
+        print(
+            f"\033[33mWarning: Cannot list the targets on {session.url} ({e}), "
+            "sending the delta against the previous push\033[0m"
+        )
+        return None
+    return {mac.upper() for mac in macs if isinstance(mac, str)}
 
 
-def sort_devices_to_files(
-    devices_list, generate_files=True, generate_targets=False, track_keys=False
+def push_target_alerts(
+    session,
+    btedr_macs,
+    btle_macs,
+    client_macs,
+    ap_macs,
+    sensor_macs,
+    ssid_list,
+    state_file=PUSH_STATE_FILE,
 ):
-    btedr_macs = []
-    btle_macs = []
-    client_macs = []
-    advertised_ssids = []
-    probed_ssids = []
-    ap_macs = []
-    sensor_macs = []
-    extracted_keys = []  # Track device keys that pass extraction criteria
+    """
+    Push devicefound targets to a running Kismet over its REST API instead of
+    rewriting kismet_target_alerts.conf and restarting it. Only the delta
+    against the targets the server currently holds is sent, in batches of
+    PUSH_BATCH_SIZE over one keep-alive session, so targets lost when Kismet
+    restarted are sent again. Only targets recorded in state_file as pushed
+    by us are ever removed, leaving those from Kismet's own configuration.
+    Kismet has no REST call for SSID canaries, so SSID targets are only
+    reported.
+    """
+    targets = set()
+    for mac_source in (btedr_macs, btle_macs, client_macs, ap_macs, sensor_macs):
+        targets.update(target_lines(mac_source))
+    pushed = read_push_state(state_file, session.url)
 
-    for device in devices_list:
-        dev_type = device.get("kismet.device.base.type")
-        mac = device.get("kismet.device.base.macaddr")
-        device_key = device.get("kismet.device.base.key")
-        device_extracted = False
+    try:
+        active = fetch_pushed_alerts(session)
+        if active is None:
+            added = sorted(targets - pushed)
+            removed = sorted(pushed - targets)
+        else:
+            lost = (pushed & targets) - active
+            if lost:
+                print(
+                    f"\033[33m{len(lost)} previously pushed targets are missing "
+                    f"on {session.url} (Kismet restarted?), sending them again\033[0m"
+                )
+            added = sorted(targets - active)
+            removed = sorted((pushed & active) - targets)
+        for path, macs in ((PUSH_ADD_PATH, added), (PUSH_REMOVE_PATH, removed)):
+            for start in range(0, len(macs), PUSH_BATCH_SIZE):
+                session.post(path, {"macs": macs[start : start + PUSH_BATCH_SIZE]})
+    except (http.client.HTTPException, OSError) as e:
+        print(f"\033[31mError pushing targets to {session.url}: {e}\033[0m")
+        sys.exit(1)
+    finally:
+        session.close()
+
+    # Targets Kismet already held from its own configuration are not ours to remove
+    write_push_state(state_file, session.url, set(added) | (pushed & targets))
+    print(
+        f"\033[32mPushed targets to {session.url}: {len(added)} added, "
+        f"{len(removed)} removed, {len(targets)} active\033[0m"
+    )
+    ssids = target_lines(ssid_list)
+    if ssids:
+        print(
+            f"\033[33mWarning: {len(ssids)} SSID targets cannot be pushed over the "
+            "REST API, use -e to write them to the Kismet configuration\033[0m"
+        )
 
-        # Handle Bluetooth devices
-        if dev_type == "BR/EDR":
-            if mac:
-                btedr_macs.append(mac)
-                device_extracted = True
 
-        # Handle Bluetooth Low Energy devices
-        if dev_type == "BTLE":
-            if mac and (
-                device.get("kismet.device.base.macaddr")
-                != device.get("kismet.device.base.commonname")
+def parse_survey_line(line):
+    """
+    Classify one Ubertooth survey line the way ubersort.sh does. Returns
+    ("UAP", "00:00:UU:LL:LL:LL") when the UAP and LAP are known, ("LAP",
+    "LL:LL:LL") when only the LAP is, and None for any other line. Octets
+    keep the case they were read in, as ubersort.sh writes them.
+    """
+    line = line.rstrip("\r\n")
+    if not SURVEY_LINE.match(line):
+        return None
+    visible = [part for part in line.split(":") if part != "??"]
+    if len(visible) == 4:
+        # The NAP is never seen over the air, fill it with 00:00
+        return "UAP", "00:00:" + ":".join(visible)
+    if len(visible) == 3:
+        return "LAP", ":".join(visible)
+    return None
+
+
+def build_bluetooth_index(btedr_macs):
+    """
+    Index full BR/EDR MAC integers by LAP and by UAP+LAP, so a survey
+    sighting resolves to its candidate addresses with one dict lookup.
+    Returns {"LAP": {lap: macs}, "UAP": {uap_lap: macs}}, where macs is a
+    single MAC integer, or a list of them for the rare shared keys, which
+    keeps the index small for captures with many Bluetooth devices.
+    """
+    index = {"LAP": {}, "UAP": {}}
+    for mac in btedr_macs:
+        for kind, key in (("LAP", mac & LAP_MASK), ("UAP", mac & UAP_LAP_MASK)):
+            entries = index[kind]
+            current = entries.get(key)
+            if current is None:
+                entries[key] = mac
+            elif isinstance(current, list):
+                current.append(mac)
+            else:
+                entries[key] = [current, mac]
+    return index
+
+
+def load_bluetooth_index(db_files, extract_mode="auto", workers=1, cache_dir=None):
+    """Build the LAP/UAP index over the BR/EDR devices of several databases"""
+    btedr_macs = mac_array()
+    for db_file, data in zip(
+        db_files,
+        load_references(
+            db_files, extract_mode=extract_mode, workers=workers, cache_dir=cache_dir
+        ),
+    ):
+        if data is None:
+            print(f"\033[33mWarning: Index database empty or invalid: {db_file}\033[0m")
+            continue
+        if not isinstance(data.btedr, array):
+            print(f"\033[33mWarning: Cannot index Bloom filter file: {db_file}\033[0m")
+            continue
+        btedr_macs = sorted_union(btedr_macs, data.btedr)
+    print(f"Indexed {len(btedr_macs)} BR/EDR addresses by LAP and UAP/LAP")
+    return build_bluetooth_index(btedr_macs)
+
+
+def resolve_survey_address(index, kind, address):
+    """Full MAC integers a survey address may belong to (empty if unknown)"""
+    if kind == "UAP":
+        key = mac_to_int(address) & UAP_LAP_MASK
+    else:
+        key = int(address.replace(":", ""), 16)
+    macs = index[kind].get(key, ())
+    return (macs,) if isinstance(macs, int) else macs
+
+
+def ingest_ubertooth_survey(source, output_prefix, index=None):
+    """
+    Stream `ubertooth-rx -z` output from a file or "-" (stdin) and write the
+    unique UAP/LAP and LAP addresses to <output_prefix>_UAP and _LAP as they
+    are first seen, so a live survey pipe can be followed. Hit counts of
+    every address are written to <output_prefix>_HITS.csv at the end.
+    With an index from build_bluetooth_index each new address is resolved to
+    its full BR/EDR MACs, written to <output_prefix>_RESOLVED.csv.
+    Returns ({uap_address: hits}, {lap: hits}, resolved MAC integers), the
+    dicts in first-seen order.
+    """
+    seen = {"UAP": {}, "LAP": {}}
+    resolved = set()
+    try:
+        survey = sys.stdin if source == "-" else open(source, "r", errors="replace")
+    except OSError as e:
+        print(f"\033[31mError: Cannot read Ubertooth survey {source}: {e}\033[0m")
+        sys.exit(1)
+
+    with open(output_prefix + SURVEY_UAP_SUFFIX, "w", buffering=1) as uap_file, open(
+        output_prefix + SURVEY_LAP_SUFFIX, "w", buffering=1
+    ) as lap_file, (
+        open(output_prefix + SURVEY_RESOLVED_SUFFIX, "w", buffering=1)
+        if index is not None
+        else nullcontext()
+    ) as resolved_file:
+        outputs = {"UAP": uap_file, "LAP": lap_file}
+        if resolved_file is not None:
+            resolved_file.write("address,type,mac\n")
+        try:
+            for line in survey:
+                parsed = parse_survey_line(line)
+                if parsed is None:
+                    continue
+                kind, address = parsed
+                hits = seen[kind]
+                if address in hits:
+                    hits[address] += 1
+                else:
+                    hits[address] = 1
+                    outputs[kind].write(address + "\n")
+                    if index is not None:
+                        for mac in resolve_survey_address(index, kind, address):
+                            resolved.add(mac)
+                            resolved_file.write(f"{address},{kind},{int_to_mac(mac)}\n")
+        except KeyboardInterrupt:
+            print("Survey input interrupted")
+        finally:
+            if survey is not sys.stdin:
+                survey.close()
+
+    rows = sorted(
+        (
+            (hits, kind, address)
+            for kind, counts in seen.items()
+            for address, hits in counts.items()
+        ),
+        key=lambda row: (-row[0], row[1], row[2]),
+    )
+    write_file_atomically(
+        output_prefix + SURVEY_HITS_SUFFIX,
+        "address,type,hits\n"
+        + "".join(f"{address},{kind},{hits}\n" for hits, kind, address in rows),
+    )
+    print(
+        f"Ubertooth survey: {len(seen['UAP'])} UAP/LAP and {len(seen['LAP'])} LAP "
+        f"addresses written to {output_prefix}{SURVEY_UAP_SUFFIX} and "
+        f"{output_prefix}{SURVEY_LAP_SUFFIX}"
+    )
+    if index is not None:
+        print(
+            f"Resolved survey addresses to {len(resolved)} BR/EDR devices in "
+            f"{output_prefix}{SURVEY_RESOLVED_SUFFIX}"
+        )
+    return seen["UAP"], seen["LAP"], resolved
+
+
+class DeviceRecord:
+    """
+    The RECORD_FIELDS of one target, as reported by --records. Iterating a
+    record yields its fields in RECORD_FIELDS order. SSID records also keep
+    sightings, the device_score() of each device key the SSID was seen on
+    (None for addresses).
+    """
+
+    __slots__ = RECORD_FIELDS + ("sightings",)
+
+    def __init__(
+        self,
+        devkey=None,
+        manuf=None,
+        commonname=None,
+        first_time=None,
+        last_time=None,
+        strongest_signal=None,
+        packets=None,
+        sightings=None,
+    ):
+        self.devkey = devkey
+        self.manuf = manuf
+        self.commonname = commonname
+        self.first_time = first_time
+        self.last_time = last_time
+        self.strongest_signal = strongest_signal
+        self.packets = packets
+        self.sightings = sightings
+
+    @classmethod
+    def from_device(cls, device):
+        """The record of one decoded device, as stored for each target it yields"""
+        signal = device.get("kismet.device.base.signal")
+        return cls(
+            device.get("kismet.device.base.key"),
+            device.get("kismet.device.base.manuf"),
+            device.get("kismet.device.base.commonname"),
+            device.get("kismet.device.base.first_time"),
+            device.get("kismet.device.base.last_time"),
+            signal.get(MAX_SIGNAL) if isinstance(signal, dict) else None,
+            device.get("kismet.device.base.packets.total"),
+        )
+
+    def __iter__(self):
+        return (getattr(self, field) for field in RECORD_FIELDS)
+
+    def __eq__(self, other):
+        return isinstance(other, DeviceRecord) and tuple(self) == tuple(other)
+
+    def __repr__(self):
+        return f"DeviceRecord{tuple(self)!r}"
+
+    def copy(self):
+        sightings = None if self.sightings is None else dict(self.sightings)
+        return DeviceRecord(*self, sightings=sightings)
+
+    def merge(self, other):
+        """
+        Fold another sighting of the same target into this record, in place:
+        the earliest first time, latest last time, strongest signal and most
+        packets win, the identifying fields come from the most recently
+        seen device, and the sightings are combined.
+        """
+        if other.sightings is not None:
+            if self.sightings is None:
+                self.sightings = {}
+            self.sightings.update(other.sightings)
+        if other.last_time is not None and (
+            self.last_time is None or other.last_time > self.last_time
+        ):
+            self.devkey = other.devkey
+            self.manuf = other.manuf
+            self.commonname = other.commonname
+        for field, pick in (
+            ("first_time", min),
+            ("last_time", max),
+            ("strongest_signal", max),
+            ("packets", max),
+        ):
+            value = getattr(other, field)
+            if value is not None:
+                current = getattr(self, field)
+                setattr(self, field, value if current is None else pick(current, value))
+        return self
+
+
+def note_target(metadata, position, value, record):
+    """Record the metadata of one target of category position"""
+    key = (position, value)
+    if key in metadata:
+        metadata[key].merge(record)
+    else:
+        metadata[key] = record.copy()
+
+
+def note_ssid(metadata, position, ssid, record):
+    """note_target() for an SSID, also noting the device it was seen on"""
+    note_target(metadata, position, ssid, record)
+    target = metadata[(position, ssid)]
+    if target.sightings is None:
+        target.sightings = {}
+    target.sightings[record.devkey] = device_score(record)
+
+
+def merge_metadata(first, second):
+    """Merge two {(category position, target): DeviceRecord} dicts"""
+    merged = {key: record.copy() for key, record in first.items()}
+    for key, record in second.items():
+        note_target(merged, key[0], key[1], record)
+    return merged
+
+
+def metadata_to_strings(metadata):
+    """
+    Serialise metadata as sorted JSON rows for the category file format, with
+    the sorted sightings of SSID records appended to their fields
+    """
+    return sorted(
+        json.dumps(
+            [position, value, *record]
+            + (
+                []
+                if record.sightings is None
+                else [sorted(record.sightings.items(), key=lambda item: str(item[0]))]
+            )
+        )
+        for (position, value), record in metadata.items()
+    )
+
+
+def metadata_from_strings(rows):
+    """Inverse of metadata_to_strings()"""
+    metadata = {}
+    for row in rows:
+        position, value, *record = json.loads(row)
+        sightings = (
+            record[len(RECORD_FIELDS)] if len(record) > len(RECORD_FIELDS) else None
+        )
+        metadata[(position, value)] = DeviceRecord(
+            *record[: len(RECORD_FIELDS)],
+            sightings=None if sightings is None else dict(map(tuple, sightings)),
+        )
+    return metadata
+
+
+class ClassificationResult:
+    """
+    The targets of one or more captures: every category of CATEGORY_NAMES
+    as a sorted MAC address array or SSID list, plus the extracted device
+    keys and the {(category position, target): DeviceRecord} metadata when
+    those were tracked (None otherwise).
+    """
+
+    __slots__ = CATEGORY_NAMES + ("keys", "metadata")
+
+    def __init__(self, categories, keys=None, metadata=None):
+        for name, values in zip(CATEGORY_NAMES, categories):
+            setattr(self, name, values)
+        self.keys = keys
+        self.metadata = metadata
+
+    @property
+    def categories(self):
+        """The categories as a tuple in CATEGORY_NAMES order"""
+        return tuple(getattr(self, name) for name in CATEGORY_NAMES)
+
+    def copy(self):
+        return ClassificationResult(self.categories, self.keys, self.metadata)
+
+    def count(self):
+        """Number of targets across all categories"""
+        return sum(map(len, self.categories))
+
+    def merge(self, other):
+        """
+        Union with another result. Keys and metadata are kept only when both
+        results tracked them.
+        """
+        return ClassificationResult(
+            (sorted_union(a, b) for a, b in zip(self.categories, other.categories)),
+            (
+                sorted_union(self.keys, other.keys)
+                if self.keys is not None and other.keys is not None
+                else None
+            ),
+            (
+                merge_metadata(self.metadata, other.metadata)
+                if self.metadata is not None and other.metadata is not None
+                else None
+            ),
+        )
+
+    def combine(self, intersects=(), baselines=()):
+        """
+        The targets also found in every result of intersects and in none of
+        baselines (see combine_references). Keys and metadata still describe
+        this result's devices.
+        """
+        return ClassificationResult(
+            combine_references(
+                self.categories,
+                [other.categories for other in intersects],
+                [other.categories for other in baselines],
+            ),
+            self.keys,
+            self.metadata,
+        )
+
+    def subtract(self, *baselines):
+        return self.combine(baselines=baselines)
+
+    def intersect(self, *others):
+        return self.combine(intersects=others)
+
+    def ranked(self, max_targets=None, quotas=None, capped=ALERT_CATEGORIES):
+        """The most relevant targets only, see rank_targets()"""
+        return rank_targets(self, max_targets, quotas, capped)
+
+    def write_files(self):
+        """Write the intermediate target files to the working directory"""
+        generate_intermediate_files(*self.categories)
+
+    def write_alerts(self):
+        """Add the targets to the Kismet target alert configuration"""
+        generate_target_alerts(
+            self.btedr, self.btle, self.client, self.ap, self.sensor, self.probed_ssids
+        )
+
+    def write_records(self, path):
+        """Write every target with its metadata to a --records file"""
+        write_target_records(path, self.categories, self.metadata or {})
+
+    def write_exchange(self, path, error_rate=None, header=None):
+        """Write the targets to an exchange file, see write_exchange_file()"""
+        write_exchange_file(path, self, error_rate, header)
+
+    def write_cleaned_database(self, source_db, dest_db):
+        """Write a copy of source_db holding only the devices of self.keys"""
+        if self.keys is None:
+            raise ValueError("device keys were not tracked for this result")
+        generate_cleaned_database(source_db, dest_db, self.keys)
+
+
+def sort_devices_to_files(
+    devices_list,
+    generate_files=True,
+    generate_targets=False,
+    track_keys=False,
+    track_metadata=False,
+):
+    """
+    Sort devices into target categories. Every category deduplicates on
+    insert; MAC addresses are kept as 48-bit integers and returned as sorted
+    arrays, SSIDs (and device keys) as sorted lists. Returns a
+    ClassificationResult, with keys and metadata set when tracked.
+    """
+    btedr_macs = set()
+    btle_macs = set()
+    client_macs = set()
+    advertised_ssids = set()
+    probed_ssids = set()
+    ap_macs = set()
+    sensor_macs = set()
+    extracted_keys = set()  # Track device keys that pass extraction criteria
+    metadata = {}
+
+    for device in devices_list:
+        dev_type = device.get("kismet.device.base.type")
+        mac = device.get("kismet.device.base.macaddr")
+        device_key = device.get("kismet.device.base.key")
+        device_extracted = False
+        mac_value = mac_to_int(mac) if mac else None
+        record = DeviceRecord.from_device(device) if track_metadata else None
+
+        # Handle Bluetooth devices
+        if dev_type in BTEDR_TYPES:
+            if mac_value is not None:
+                btedr_macs.add(mac_value)
+                device_extracted = True
+                if record:
+                    note_target(metadata, 0, mac_value, record)
+
+        # Handle Bluetooth Low Energy devices
+        if dev_type in BTLE_TYPES:
+            if mac_value is not None and (
+                device.get("kismet.device.base.macaddr")
+                != device.get("kismet.device.base.commonname")
                 or device.get("kismet.device.base.manuf") != "Unknown"
             ):
-                btle_macs.append(mac)
+                btle_macs.add(mac_value)
                 device_extracted = True
+                if record:
+                    note_target(metadata, 1, mac_value, record)
 
         # Handle Wi-Fi Clients and their probed SSIDs
-        elif dev_type in [
-            "Wi-Fi Client",
-            "Wi-Fi Ad-Hoc",
-            "Wi-Fi Device",
-            "Wi-Fi Bridged",
-        ]:
-            if mac and device.get("kismet.device.base.manuf") != "Unknown":
-                client_macs.append(mac)
+        elif dev_type in WIFI_CLIENT_TYPES:
+            if (
+                mac_value is not None
+                and device.get("kismet.device.base.manuf") != "Unknown"
+            ):
+                client_macs.add(mac_value)
                 device_extracted = True
+                if record:
+                    note_target(metadata, 2, mac_value, record)
 
             # Extract probed SSIDs
             try:
@@ -363,15 +1829,21 @@ def sort_devices_to_files(
                     ssid = map.get("dot11.probedssid.ssid")
                     if ssid != "":
                         ssids.append(ssid)
-                probed_ssids.extend(ssids)  # Store unique SSIDs for later use
+                probed_ssids.update(ssids)  # Store unique SSIDs for later use
+                if record:
+                    for ssid in ssids:
+                        if ssid is not None:
+                            note_ssid(metadata, 6, ssid, record)
             except:
                 pass
 
         # Handle Wi-Fi APs and their advertised SSIDs
-        elif dev_type in ["Wi-Fi AP", "Wi-Fi WDS AP", "WiFi WDS"]:
-            if mac:
-                ap_macs.append(mac)
+        elif dev_type in WIFI_AP_TYPES:
+            if mac_value is not None:
+                ap_macs.add(mac_value)
                 device_extracted = True
+                if record:
+                    note_target(metadata, 3, mac_value, record)
 
             # Extract advertised SSIDs
             try:
@@ -383,18 +1855,33 @@ def sort_devices_to_files(
                     ssid = map.get("dot11.advertisedssid.ssid")
                     if ssid:
                         ssids.append(ssid)
-                advertised_ssids.extend(ssids)
+                advertised_ssids.update(ssids)
+                if record:
+                    for ssid in ssids:
+                        note_ssid(metadata, 5, ssid, record)
             except:
                 pass
 
         # Handle Sensors
-        elif dev_type == "Sensor" and mac:
-            sensor_macs.append(mac)
+        elif dev_type in SENSOR_TYPES and mac_value is not None:
+            sensor_macs.add(mac_value)
             device_extracted = True
+            if record:
+                note_target(metadata, 4, mac_value, record)
 
         # Track extracted device keys
         if track_keys and device_extracted and device_key:
-            extracted_keys.append(device_key)
+            extracted_keys.add(device_key)
+
+    # Freeze into sorted containers for output and sorted-merge set algebra
+    btedr_macs = mac_array(sorted(btedr_macs))
+    btle_macs = mac_array(sorted(btle_macs))
+    client_macs = mac_array(sorted(client_macs))
+    ap_macs = mac_array(sorted(ap_macs))
+    sensor_macs = mac_array(sorted(sensor_macs))
+    advertised_ssids = sorted(advertised_ssids)
+    probed_ssids = sorted(ssid for ssid in probed_ssids if ssid is not None)
+    extracted_keys = sorted(extracted_keys)
 
     if generate_files:
         # Generate intermediate files only
@@ -414,8 +1901,8 @@ def sort_devices_to_files(
             btedr_macs, btle_macs, client_macs, ap_macs, sensor_macs, probed_ssids
         )
 
-    if track_keys:
-        return (
+    return ClassificationResult(
+        (
             btedr_macs,
             btle_macs,
             client_macs,
@@ -423,102 +1910,1052 @@ def sort_devices_to_files(
             sensor_macs,
             advertised_ssids,
             probed_ssids,
-            extracted_keys,
-        )
-    return (
-        btedr_macs,
-        btle_macs,
-        client_macs,
-        ap_macs,
-        sensor_macs,
-        advertised_ssids,
-        probed_ssids,
+        ),
+        extracted_keys if track_keys else None,
+        metadata if track_metadata else None,
     )
 
 
+def sorted_matches(small, large):
+    """Yield indexes (i, j) where small[i] == large[j], for sorted unique sequences"""
+    low = 0
+    size = len(large)
+    for index, value in enumerate(small):
+        low = bisect_left(large, value, low)
+        if low == size:
+            return
+        if large[low] == value:
+            yield index, low
+
+
+def like(template, values, other=None):
+    """Build a container of the same kind as template (MAC array or list)"""
+    if isinstance(template, array) or isinstance(other, array):
+        return mac_array(values)
+    return list(values)
+
+
+def sorted_intersection(first, second):
+    """Intersect two sorted unique sequences by walking the smaller one"""
+    small, large = (first, second) if len(first) <= len(second) else (second, first)
+    return like(first, (small[i] for i, _ in sorted_matches(small, large)), second)
+
+
+def sorted_difference(first, second):
+    """Remove the values of sorted `second` from sorted `first` with a merge"""
+    if not first or not second:
+        return like(first, first, second)
+    if len(first) <= len(second):
+        drop = {i for i, _ in sorted_matches(first, second)}
+        return like(first, (v for i, v in enumerate(first) if i not in drop), second)
+    # Walk the smaller baseline and keep the slices of `first` between matches
+    result = like(first, (), second)
+    start = 0
+    for _, index in sorted_matches(second, first):
+        result.extend(first[start:index])
+        start = index + 1
+    result.extend(first[start:])
+    return result
+
+
+def sorted_union(first, second):
+    """Union of two sorted unique sequences, still sorted and unique"""
+    return like(first, sorted(chain(first, sorted_difference(second, first))), second)
+
+
+def as_sorted(values):
+    """Coerce a category to a sorted unique sequence (arrays pass through)"""
+    if isinstance(values, array):
+        return values
+    values = {value for value in values if value is not None}
+    if values and all(isinstance(value, int) for value in values):
+        return mac_array(sorted(values))
+    return sorted(values)
+
+
 def subtract_baseline(new_data, baseline_data):
     """
     Subtract baseline MACs/SSIDs/etc. from new data
-    Returns the filtered version of (btedr, btle, client, ap, sensor, adv_ssids, probed_ssids)
-    """
-    (
-        new_btedr,
-        new_btle,
-        new_client,
-        new_ap,
-        new_sensor,
-        new_adv_ssids,
-        new_probed_ssids,
-    ) = new_data
-    (
-        base_btedr,
-        base_btle,
-        base_client,
-        base_ap,
-        base_sensor,
-        base_adv_ssids,
-        base_probed_ssids,
-    ) = baseline_data
-
-    return (
-        list(set(new_btedr) - set(base_btedr)),
-        list(set(new_btle) - set(base_btle)),
-        list(set(new_client) - set(base_client)),
-        list(set(new_ap) - set(base_ap)),
-        list(set(new_sensor) - set(base_sensor)),
-        list(set(new_adv_ssids) - set(base_adv_ssids)),
-        list(set(new_probed_ssids) - set(base_probed_ssids)),
+    Returns the filtered ClassificationResult
+    """
+    return ClassificationResult(
+        (
+            sorted_difference(as_sorted(new), as_sorted(base))
+            for new, base in zip(new_data.categories, baseline_data.categories)
+        ),
+        new_data.keys,
+        new_data.metadata,
     )
 
 
 def intersect_baseline(new_data, intersect_data):
     """
     Intersect new data with intersect data to find common MACs/SSIDs/etc.
-    Returns the intersected version of (btedr, btle, client, ap, sensor, adv_ssids, probed_ssids)
-    """
-    (
-        new_btedr,
-        new_btle,
-        new_client,
-        new_ap,
-        new_sensor,
-        new_adv_ssids,
-        new_probed_ssids,
-    ) = new_data
-    (
-        int_btedr,
-        int_btle,
-        int_client,
-        int_ap,
-        int_sensor,
-        int_adv_ssids,
-        int_probed_ssids,
-    ) = intersect_data
-
-    return (
-        list(set(new_btedr) & set(int_btedr)),
-        list(set(new_btle) & set(int_btle)),
-        list(set(new_client) & set(int_client)),
-        list(set(new_ap) & set(int_ap)),
-        list(set(new_sensor) & set(int_sensor)),
-        list(set(new_adv_ssids) & set(int_adv_ssids)),
-        list(set(new_probed_ssids) & set(int_probed_ssids)),
-    )
-
-
-def load_and_sort_devices(db_file, track_keys=False):
-    """Helper function: connect to DB, extract device JSON, sort into categories"""
+    Returns the intersected ClassificationResult
+    """
+    return ClassificationResult(
+        (
+            sorted_intersection(as_sorted(new), as_sorted(other))
+            for new, other in zip(new_data.categories, intersect_data.categories)
+        ),
+        new_data.keys,
+        new_data.metadata,
+    )
+
+
+def combine_references(new_data, intersect_datas, baseline_datas):
+    """
+    Apply any number of intersect and baseline databases at once:
+    new & intersect_1 & ... & intersect_n - baseline_1 - ... - baseline_m.
+    Each category is intersected smallest set first, so the working set only
+    shrinks, and baselines are skipped once nothing is left to remove. All
+    operations are merges over sorted sequences, except against the hashed
+    SSIDs and Bloom filters of exchange files, which are membership tests.
+    Returns the (btedr, btle, client, ap, sensor, adv_ssids, probed_ssids)
+    layout.
+    """
+    combined = []
+    for index, new_values in enumerate(new_data):
+        new_values = as_sorted(new_values)
+        operands = sorted(
+            [reference_values(data[index]) for data in intersect_datas], key=len
+        )
+        result = new_values
+        for values in operands:
+            if not result:
+                break
+            if isinstance(values, TargetSet):
+                result = like(result, (value for value in result if value in values))
+            else:
+                result = sorted_intersection(result, values)
+        for data in sorted(baseline_datas, key=lambda data: len(data[index])):
+            if not result:
+                break
+            values = reference_values(data[index])
+            if isinstance(values, TargetSet):
+                result = like(
+                    result, (value for value in result if value not in values)
+                )
+            else:
+                result = sorted_difference(result, values)
+        combined.append(like(new_values, result))
+    return tuple(combined)
+
+
+def reference_values(values):
+    """as_sorted() for reference categories, passing exchange file TargetSets through"""
+    return values if isinstance(values, TargetSet) else as_sorted(values)
+
+
+def classify_devices(
+    conn, track_keys=False, extract_mode="auto", filters=None, track_metadata=False
+):
+    """
+    Stream devices from an open connection and sort them into categories,
+    reading every device from one snapshot
+    """
+    with read_snapshot(conn):
+        devices = iter_devices(
+            conn, mode=extract_mode, filters=filters, metadata=track_metadata
+        )
+        first = next(devices, None)
+        if first is None:
+            return None
+        # Devices are decoded and classified one at a time, so only the
+        # category lists are held in memory rather than the whole table
+        return sort_devices_to_files(
+            chain([first], devices),
+            generate_files=False,
+            generate_targets=False,
+            track_keys=track_keys,
+            track_metadata=track_metadata,
+        )
+
+
+def classify_rowid_range(
+    db_file, rowid_range, track_keys, extract_mode, track_metadata=False, window=None
+):
+    """Worker process entry point: classify one rowid range of the devices table"""
+    conn = open_read_only(db_file)
+    try:
+        return classify_devices(
+            conn,
+            track_keys=track_keys,
+            extract_mode=extract_mode,
+            filters=device_filter(rowid_range=rowid_range, window=window),
+            track_metadata=track_metadata,
+        )
+    finally:
+        conn.close()
+
+
+def split_rowid_ranges(conn, parts, since_rowid=None):
+    """Split the devices table into up to `parts` contiguous rowid ranges"""
+    low, high = conn.execute(
+        "SELECT MIN(rowid), MAX(rowid) FROM devices WHERE rowid >= ?",
+        (since_rowid or 0,),
+    ).fetchone()
+    if low is None:
+        return []
+    step = max(1, -(-(high - low + 1) // parts))
+    return [
+        (start, min(start + step - 1, high)) for start in range(low, high + 1, step)
+    ]
+
+
+def merge_sorted_results(results):
+    """Union per-range ClassificationResults into one (None if all are None)"""
+    results = [result for result in results if result is not None]
+    if not results:
+        return None
+    merged = results[0]
+    for result in results[1:]:
+        merged = merged.merge(result)
+    return merged
+
+
+@profiled
+def load_and_sort_devices(
+    db_file,
+    track_keys=False,
+    extract_mode="auto",
+    workers=1,
+    since_rowid=None,
+    track_metadata=False,
+    window=None,
+):
+    """
+    Helper function: connect to DB, stream device JSON, sort into categories.
+    With since_rowid only device rows at or above that rowid are read, and
+    with window only devices seen within it.
+    """
     conn = create_connection(db_file)
     if conn is None:
         print(f"Database connection failed: {db_file}")
         return None
-    devices = extract_devices_json(conn)
-    conn.close()
-    if not devices:
+    try:
+        if workers <= 1:
+            return classify_devices(
+                conn,
+                track_keys=track_keys,
+                extract_mode=extract_mode,
+                filters=device_filter(since_rowid=since_rowid, window=window),
+                track_metadata=track_metadata,
+            )
+        try:
+            ranges = split_rowid_ranges(conn, workers, since_rowid)
+        except Error as e:
+            print("Error querying 'devices' table:", e)
+            return None
+    finally:
+        conn.close()
+
+    # Each rowid range is read and classified in its own process; merging
+    # the results in range order reproduces the single-process lists
+    print(f"Classifying {len(ranges)} rowid ranges across {workers} workers")
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = map_counted(
+            pool,
+            classify_rowid_range,
+            [db_file] * len(ranges),
+            ranges,
+            [track_keys] * len(ranges),
+            [extract_mode] * len(ranges),
+            [track_metadata] * len(ranges),
+            [window] * len(ranges),
+        )
+    return merge_sorted_results(results)
+
+
+def database_fingerprint(db_file):
+    """
+    Identify a database's current contents by path, size, mtime and a hash of
+    its first and last FINGERPRINT_BYTES (which cover the SQLite header and
+    change counter), plus the size and mtime of any write-ahead log.
+    """
+    stat = os.stat(db_file)
+    digest = hashlib.blake2b(digest_size=16)
+    with open(db_file, "rb") as f:
+        digest.update(f.read(FINGERPRINT_BYTES))
+        if stat.st_size > FINGERPRINT_BYTES:
+            f.seek(max(FINGERPRINT_BYTES, stat.st_size - FINGERPRINT_BYTES))
+            digest.update(f.read(FINGERPRINT_BYTES))
+    wal_file = f"{db_file}-wal"
+    if os.path.isfile(wal_file):
+        wal_stat = os.stat(wal_file)
+        digest.update(f"{wal_stat.st_size}:{wal_stat.st_mtime_ns}".encode())
+    return {
+        "path": os.path.abspath(db_file),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "fingerprint": digest.hexdigest(),
+    }
+
+
+def pack_strings(values):
+    """Pack strings as a count, a table of byte lengths and the UTF-8 bytes"""
+    encoded = [value.encode("utf-8", "surrogatepass") for value in values]
+    lengths = struct.pack(f"<I{len(encoded)}I", len(encoded), *map(len, encoded))
+    return lengths + b"".join(encoded)
+
+
+def unpack_strings(payload, offset):
+    """Unpack one pack_strings() block, returning (strings, next offset)"""
+    (count,) = struct.unpack_from("<I", payload, offset)
+    offset += 4
+    lengths = struct.unpack_from(f"<{count}I", payload, offset)
+    offset += 4 * count
+    values = []
+    for length in lengths:
+        values.append(
+            payload[offset : offset + length].decode("utf-8", "surrogatepass")
+        )
+        offset += length
+    return values, offset
+
+
+def pack_macs(values):
+    """Pack a sorted MAC array as a count and little-endian 64-bit integers"""
+    values = array("Q", values)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return struct.pack("<I", len(values)) + values.tobytes()
+
+
+def unpack_macs(payload, offset):
+    """Unpack one pack_macs() block, returning (MAC array, next offset)"""
+    (count,) = struct.unpack_from("<I", payload, offset)
+    offset += 4
+    values = mac_array()
+    values.frombytes(payload[offset : offset + 8 * count])
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values, offset + 8 * count
+
+
+def write_category_file(path, header, categories):
+    """
+    Atomically write categories in the compact binary category format:
+    magic, version, a JSON header, then every category zlib-compressed,
+    each as a type tag followed by sorted MAC integers (b"M") or sorted
+    length-prefixed UTF-8 strings (b"S").
+    """
+    header_bytes = json.dumps(header, sort_keys=True).encode()
+    blocks = []
+    for values in categories:
+        values = as_sorted(values)
+        if isinstance(values, array):
+            blocks.append(b"M" + pack_macs(values))
+        else:
+            blocks.append(b"S" + pack_strings(values))
+    body = b"".join(blocks)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(CATEGORY_FILE_MAGIC)
+        f.write(struct.pack("<HI", CATEGORY_FILE_VERSION, len(header_bytes)))
+        f.write(header_bytes)
+        f.write(zlib.compress(body))
+    os.replace(tmp_path, path)
+
+
+def read_category_file(path):
+    """Read a write_category_file() file, returning (header, categories) or None"""
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+        prefix = len(CATEGORY_FILE_MAGIC)
+        if data[:prefix] != CATEGORY_FILE_MAGIC:
+            return None
+        version, header_length = struct.unpack_from("<HI", data, prefix)
+        if version != CATEGORY_FILE_VERSION:
+            return None
+        offset = prefix + struct.calcsize("<HI")
+        header = json.loads(data[offset : offset + header_length])
+        payload = zlib.decompress(data[offset + header_length :])
+        categories = []
+        offset = 0
+        while offset < len(payload):
+            tag = payload[offset : offset + 1]
+            if tag == b"M":
+                values, offset = unpack_macs(payload, offset + 1)
+            else:
+                values, offset = unpack_strings(payload, offset + 1)
+            categories.append(values)
+        return header, tuple(categories)
+    except (OSError, ValueError, struct.error, zlib.error) as e:
+        print(f"\033[33mWarning: Unreadable category file {path}: {e}\033[0m")
+        return None
+
+
+def target_digest(value):
+    """16-byte digest of a MAC integer or SSID, as used by exchange files"""
+    if isinstance(value, int):
+        data = value.to_bytes(6, "big")
+    else:
+        data = value.encode("utf-8", "surrogatepass")
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def target_hash(value):
+    """64-bit hash of a target, stored for SSIDs in exchange files"""
+    return int.from_bytes(target_digest(value)[:8], "little")
+
+
+class TargetSet:
+    """
+    A reference category that can only be tested for membership, loaded
+    from an exchange file; combine_references() filters against it
+    """
+
+    __slots__ = ()
+
+
+class HashedTargets(TargetSet):
+    """Sorted target_hash() values of the SSIDs of an exchange file"""
+
+    __slots__ = ("hashes",)
+
+    def __init__(self, hashes):
+        self.hashes = hashes
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def __contains__(self, value):
+        key = target_hash(value)
+        index = bisect_left(self.hashes, key)
+        return index < len(self.hashes) and self.hashes[index] == key
+
+
+class BloomFilter(TargetSet):
+    """
+    Bloom filter over the targets of one category: never misses a target it
+    was built from, and wrongly matches others at about its error rate
+    """
+
+    __slots__ = ("count", "size", "hashes", "bits")
+
+    def __init__(self, count, size, hashes, bits):
+        self.count = count
+        self.size = size
+        self.hashes = hashes
+        self.bits = bits
+
+    @classmethod
+    def build(cls, values, error_rate):
+        count = len(values)
+        size = max(8, math.ceil(-count * math.log(error_rate) / math.log(2) ** 2))
+        hashes = max(1, round(size / max(count, 1) * math.log(2)))
+        bloom = cls(count, size, hashes, bytearray((size + 7) // 8))
+        for value in values:
+            for position in bloom.positions(value):
+                bloom.bits[position >> 3] |= 1 << (position & 7)
+        return bloom
+
+    def positions(self, value):
+        digest = target_digest(value)
+        first = int.from_bytes(digest[:8], "little")
+        step = int.from_bytes(digest[8:], "little") | 1
+        return ((first + i * step) % self.size for i in range(self.hashes))
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, value):
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self.positions(value)
+        )
+
+
+def pack_deltas(values):
+    """Pack sorted unsigned integers as a varint count and varint deltas"""
+    numbers = [len(values)]
+    previous = 0
+    for value in values:
+        numbers.append(value - previous)
+        previous = value
+    out = bytearray()
+    for number in numbers:
+        while number >= 0x80:
+            out.append(number & 0x7F | 0x80)
+            number >>= 7
+        out.append(number)
+    return bytes(out)
+
+
+def unpack_deltas(payload, offset):
+    """
+    Unpack one pack_deltas() block, returning (array('Q'), next offset).
+    Raises ValueError if the block runs past the end of payload.
+    """
+    numbers = []
+    number = shift = 0
+    count = None
+    while count is None or len(numbers) < count:
+        if offset >= len(payload):
+            raise ValueError("delta block runs past the end of the data")
+        byte = payload[offset]
+        offset += 1
+        number |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        if count is None:
+            count = number
+        else:
+            numbers.append(number)
+        number = shift = 0
+    return array("Q", accumulate(numbers)), offset
+
+
+def write_exchange_file(path, result, error_rate=None, header=None):
+    """
+    Atomically write result as a target set exchange file: magic, version,
+    a JSON header, then every category zlib-compressed. MAC categories are
+    stored as delta-encoded sorted integers (b"M") and SSIDs as sorted
+    target_hash() values (b"H"), or, with error_rate, every category as a
+    Bloom filter with that false positive rate (b"B").
+    """
+    header = dict(header or {})
+    header["counts"] = dict(zip(CATEGORY_NAMES, map(len, result.categories)))
+    header["bloom_error_rate"] = error_rate
+    blocks = []
+    for values in result.categories:
+        if error_rate is not None:
+            bloom = BloomFilter.build(values, error_rate)
+            blocks.append(
+                b"B"
+                + struct.pack("<QQB", bloom.count, bloom.size, bloom.hashes)
+                + bytes(bloom.bits)
+            )
+        elif isinstance(values, array):
+            blocks.append(b"M" + pack_deltas(values))
+        else:
+            blocks.append(b"H" + pack_deltas(sorted(map(target_hash, values))))
+    header_bytes = json.dumps(header, sort_keys=True).encode()
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(EXCHANGE_MAGIC)
+        f.write(struct.pack("<HI", EXCHANGE_VERSION, len(header_bytes)))
+        f.write(header_bytes)
+        f.write(zlib.compress(b"".join(blocks), 9))
+    os.replace(tmp_path, path)
+
+
+def is_exchange_file(path):
+    """Whether path starts with the exchange file magic"""
+    try:
+        with open(path, "rb") as f:
+            return f.read(len(EXCHANGE_MAGIC)) == EXCHANGE_MAGIC
+    except OSError:
+        return False
+
+
+def read_exchange_file(path):
+    """
+    Read a write_exchange_file() file, returning (header, ClassificationResult)
+    or None. Hashed and Bloom filter categories come back as TargetSets.
+    """
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+        offset = len(EXCHANGE_MAGIC)
+        version, header_length = struct.unpack_from("<HI", data, offset)
+        if version != EXCHANGE_VERSION:
+            print(
+                f"\033[31mError: {path} is exchange format version {version}, "
+                f"only version {EXCHANGE_VERSION} is supported\033[0m"
+            )
+            return None
+        offset += struct.calcsize("<HI")
+        header = json.loads(data[offset : offset + header_length])
+        payload = zlib.decompress(data[offset + header_length :])
+        categories = []
+        offset = 0
+        while offset < len(payload):
+            tag = payload[offset : offset + 1]
+            offset += 1
+            if tag == b"B":
+                count, size, hashes = struct.unpack_from("<QQB", payload, offset)
+                offset += struct.calcsize("<QQB")
+                end = offset + (size + 7) // 8
+                if end > len(payload):
+                    raise ValueError("Bloom filter runs past the end of the data")
+                categories.append(BloomFilter(count, size, hashes, payload[offset:end]))
+                offset = end
+                continue
+            if tag not in (b"M", b"H"):
+                raise ValueError(f"unknown category tag {tag!r}")
+            values, offset = unpack_deltas(payload, offset)
+            categories.append(
+                mac_array(values) if tag == b"M" else HashedTargets(values)
+            )
+    except (OSError, ValueError, OverflowError, struct.error, zlib.error) as e:
+        print(f"\033[31mError: Unreadable exchange file {path}: {e}\033[0m")
+        return None
+    if len(categories) != len(CATEGORY_NAMES):
+        print(f"\033[31mError: Truncated exchange file {path}\033[0m")
+        return None
+    return header, ClassificationResult(categories)
+
+
+def cache_entry_path(cache_dir, db_file, window=None):
+    """
+    Cache file for a database, named after a hash of its absolute path and
+    of the device window, so every window is cached separately
+    """
+    key = os.path.abspath(db_file)
+    if window is not None:
+        key += json.dumps(window)
+    name = hashlib.sha256(key.encode()).hexdigest()[:32]
+    return os.path.join(cache_dir, name + CACHE_SUFFIX)
+
+
+def cache_header(db_file, window=None):
+    """Header of a cache entry: the database fingerprint and the window"""
+    header = database_fingerprint(db_file)
+    if window is not None:
+        header["window"] = list(window)
+    return header
+
+
+def read_cached_categories(cache_dir, db_file, window=None):
+    """Return cached categories for db_file, or None on a miss or stale entry"""
+    path = cache_entry_path(cache_dir, db_file, window)
+    if not os.path.isfile(path):
+        return None
+    entry = read_category_file(path)
+    stat = os.stat(db_file)
+    if entry is not None:
+        header, categories = entry
+        # Compare the cheap stat fields before hashing the database
+        if (
+            header.get("size") == stat.st_size
+            and header.get("mtime_ns") == stat.st_mtime_ns
+            and header == cache_header(db_file, window)
+        ):
+            os.utime(path)  # Mark the entry as recently used for LRU eviction
+            return ClassificationResult(categories)
+    print(f"\033[33mDiscarding stale cache entry for {db_file}\033[0m")
+    os.remove(path)
+    return None
+
+
+def evict_cache(cache_dir, max_bytes):
+    """Delete least recently used cache entries until the cache fits max_bytes"""
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith(CACHE_SUFFIX):
+            path = os.path.join(cache_dir, name)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime_ns, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass  # Already evicted by a concurrent load
+        total -= size
+
+
+def write_cached_categories(cache_dir, db_file, result, max_bytes, window=None):
+    """Store the categories of result for db_file and enforce the cache size cap"""
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        write_category_file(
+            cache_entry_path(cache_dir, db_file, window),
+            cache_header(db_file, window),
+            result.categories,
+        )
+        evict_cache(cache_dir, max_bytes)
+    except OSError as e:
+        print(f"\033[33mWarning: Could not update cache in {cache_dir}: {e}\033[0m")
+
+
+def load_reference_devices(
+    db_file,
+    extract_mode="auto",
+    workers=1,
+    cache_dir=None,
+    cache_max_mb=CACHE_MAX_MB,
+    exclude_captures=(),
+    window=None,
+    track_metadata=False,
+):
+    """
+    Load the categories of a baseline/intersect database, served from the
+    on-disk cache when it still matches the database and window, so a hit
+    never opens SQLite or decodes JSON. store: references are answered by
+    the target store instead, leaving out exclude_captures; they keep no
+    per-capture times or signals, so window does not apply to them. The
+    cache holds no per-target metadata, so track_metadata always reads the
+    database.
+    """
+    if db_file.startswith(STORE_PREFIX):
+        return load_store_reference(db_file, exclude_captures)
+    if is_exchange_file(db_file):
+        return load_exchange_reference(db_file, window)
+
+    if cache_dir and os.path.isfile(db_file) and not track_metadata:
+        categories = read_cached_categories(cache_dir, db_file, window)
+        if categories is not None:
+            print(f"Loaded cached categories for {db_file}")
+            return categories
+
+    categories = load_and_sort_devices(
+        db_file,
+        extract_mode=extract_mode,
+        workers=workers,
+        track_metadata=track_metadata,
+        window=window,
+    )
+    if categories is not None and cache_dir:
+        write_cached_categories(
+            cache_dir, db_file, categories, cache_max_mb * 1024 * 1024, window
+        )
+    return categories
+
+
+def load_references(
+    db_files,
+    extract_mode="auto",
+    workers=1,
+    cache_dir=None,
+    cache_max_mb=CACHE_MAX_MB,
+    exclude_captures=(),
+    window=None,
+    track_metadata=False,
+):
+    """
+    Load several baseline/intersect databases concurrently, one process per
+    database, sharing the --workers budget between them. Returns the
+    categories of each database in order (None for empty or invalid ones).
+    """
+    if len(db_files) <= 1:
+        return [
+            load_reference_devices(
+                db_file,
+                extract_mode,
+                workers,
+                cache_dir,
+                cache_max_mb,
+                exclude_captures,
+                window,
+                track_metadata,
+            )
+            for db_file in db_files
+        ]
+
+    per_database = max(1, workers // len(db_files))
+    with ProcessPoolExecutor(
+        max_workers=min(len(db_files), os.cpu_count() or 1)
+    ) as pool:
+        return map_counted(
+            pool,
+            load_reference_devices,
+            db_files,
+            [extract_mode] * len(db_files),
+            [per_database] * len(db_files),
+            [cache_dir] * len(db_files),
+            [cache_max_mb] * len(db_files),
+            [exclude_captures] * len(db_files),
+            [window] * len(db_files),
+            [track_metadata] * len(db_files),
+        )
+
+
+def open_target_store(store_file):
+    """
+    Open (creating if needed) the persistent target store: one row per
+    capture, one per target ever seen with its first/last seen time, and the
+    captures each target was seen in. MAC targets are stored as integers;
+    the target_list view shows them as colon-hex.
+    """
+    conn = sqlite3.connect(store_file)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS captures (
+            id INTEGER PRIMARY KEY,
+            path TEXT NOT NULL UNIQUE,
+            name TEXT NOT NULL,
+            added INTEGER NOT NULL,
+            updated INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS captures_name ON captures (name);
+        CREATE TABLE IF NOT EXISTS targets (
+            category TEXT NOT NULL,
+            target NOT NULL,
+            first_seen INTEGER,
+            last_seen INTEGER,
+            PRIMARY KEY (category, target)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS sightings (
+            category TEXT NOT NULL,
+            target NOT NULL,
+            capture_id INTEGER NOT NULL REFERENCES captures (id),
+            PRIMARY KEY (category, target, capture_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS sightings_capture
+            ON sightings (capture_id, category, target);
+        CREATE VIEW IF NOT EXISTS target_list AS
+            SELECT category,
+                CASE WHEN typeof(target) = 'integer' THEN printf(
+                    '%02X:%02X:%02X:%02X:%02X:%02X',
+                    (target >> 40) & 255, (target >> 32) & 255, (target >> 24) & 255,
+                    (target >> 16) & 255, (target >> 8) & 255, target & 255)
+                ELSE target END AS target,
+                first_seen, last_seen,
+                (SELECT group_concat(c.name, ';') FROM sightings AS s
+                 JOIN captures AS c ON c.id = s.capture_id
+                 WHERE s.category = t.category AND s.target = t.target) AS captures
+            FROM targets AS t;
+        """)
+    return conn
+
+
+def upsert_target_store(store_file, db_file, name, result):
+    """
+    Record the targets of one capture's ClassificationResult in the store,
+    with first/last seen taken from its metadata. Targets already known
+    keep their earliest first_seen and latest last_seen; the capture's
+    sightings are replaced, so re-parsing a capture does not pile up.
+    """
+    now = int(time.time())
+    metadata = result.metadata or {}
+    empty = DeviceRecord()
+    conn = open_target_store(store_file)
+    try:
+        with conn:
+            conn.execute(
+                "INSERT INTO captures (path, name, added, updated) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (path) DO UPDATE SET name = excluded.name, "
+                "updated = excluded.updated",
+                (os.path.abspath(db_file), name, now, now),
+            )
+            (capture_id,) = conn.execute(
+                "SELECT id FROM captures WHERE path = ?", (os.path.abspath(db_file),)
+            ).fetchone()
+            rows = [
+                (category, value, record.first_time, record.last_time)
+                for position, (category, values) in enumerate(
+                    zip(CATEGORY_NAMES, result.categories)
+                )
+                for value in values
+                for record in (metadata.get((position, value), empty),)
+            ]
+            conn.executemany(
+                "INSERT INTO targets (category, target, first_seen, last_seen) "
+                "VALUES (?, ?, ?, ?) ON CONFLICT (category, target) DO UPDATE SET "
+                "first_seen = min(coalesce(first_seen, excluded.first_seen), "
+                "coalesce(excluded.first_seen, first_seen)), "
+                "last_seen = max(coalesce(last_seen, excluded.last_seen), "
+                "coalesce(excluded.last_seen, last_seen))",
+                rows,
+            )
+            conn.execute("DELETE FROM sightings WHERE capture_id = ?", (capture_id,))
+            conn.executemany(
+                "INSERT OR IGNORE INTO sightings (category, target, capture_id) "
+                "VALUES (?, ?, ?)",
+                ((category, value, capture_id) for category, value, _, _ in rows),
+            )
+    except Error as e:
+        print(f"\033[31mError updating target store {store_file}: {e}\033[0m")
+        sys.exit(1)
+    finally:
+        conn.close()
+    print(f"Target store {store_file}: {len(rows)} targets recorded for {name}")
+
+
+def parse_store_reference(spec):
+    """Split store:FILE[#PATTERN,...] into (FILE, [capture name patterns])"""
+    store_file, _, patterns = spec[len(STORE_PREFIX) :].partition("#")
+    return store_file, [pattern for pattern in patterns.split(",") if pattern]
+
+
+def load_store_reference(spec, exclude_captures=()):
+    """
+    Categories of every target seen in the store's captures whose names
+    match the spec's patterns (all captures if none are given), leaving out
+    exclude_captures so a capture is never compared against itself. Each
+    category is one indexed range query, already in sorted order.
+    """
+    store_file, patterns = parse_store_reference(spec)
+    if not os.path.isfile(store_file):
+        print(f"\033[31mError: Target store not found: {store_file}\033[0m")
+        return None
+    conn = sqlite3.connect(f"{Path(store_file).resolve().as_uri()}?mode=ro", uri=True)
+    try:
+        excluded = {os.path.abspath(path) for path in exclude_captures}
+        capture_ids = [
+            capture_id
+            for capture_id, name, path in conn.execute(
+                "SELECT id, name, path FROM captures"
+            )
+            if path not in excluded
+            and (
+                not patterns
+                or any(fnmatch.fnmatchcase(name, pattern) for pattern in patterns)
+            )
+        ]
+        if not capture_ids:
+            return None
+        conn.execute("CREATE TEMP TABLE selected (capture_id INTEGER PRIMARY KEY)")
+        conn.executemany(
+            "INSERT INTO selected VALUES (?)",
+            ((capture_id,) for capture_id in capture_ids),
+        )
+        categories = []
+        for category in CATEGORY_NAMES:
+            values = [
+                value
+                for (value,) in conn.execute(
+                    "SELECT DISTINCT target FROM sightings WHERE category = ? "
+                    "AND capture_id IN (SELECT capture_id FROM selected) "
+                    "ORDER BY target",
+                    (category,),
+                )
+            ]
+            # Targets of the MAC categories are integers, SSIDs are strings
+            categories.append(
+                sorted(values) if category.endswith("_ssids") else mac_array(values)
+            )
+    except Error as e:
+        print(f"\033[31mError querying target store {store_file}: {e}\033[0m")
         return None
-    return sort_devices_to_files(
-        devices, generate_files=False, generate_targets=False, track_keys=track_keys
+    finally:
+        conn.close()
+    result = ClassificationResult(categories)
+    print(
+        f"Loaded {result.count()} targets of {len(capture_ids)} captures "
+        f"from target store {store_file}"
     )
+    return result
+
+
+def load_exchange_reference(path, window=None):
+    """
+    The target sets of an exchange file, warning when they were exported
+    with another --since/--until/--min-signal window than this run uses
+    """
+    entry = read_exchange_file(path)
+    if entry is None:
+        return None
+    header, result = entry
+    if header.get("window") != (window and list(window)):
+        print(
+            f"\033[33mWarning: {path} was exported with device window "
+            f"{header.get('window')}, not {window and list(window)}\033[0m"
+        )
+    kind = "Bloom filters" if header.get("bloom_error_rate") else "target sets"
+    print(f"Loaded {kind} of {header.get('source', path)} from exchange file {path}")
+    return result
+
+
+def max_device_rowid(db_file):
+    """Return the highest rowid currently in the devices table (0 if empty)"""
+    conn = open_read_only(db_file)
+    try:
+        return conn.execute("SELECT MAX(rowid) FROM devices").fetchone()[0] or 0
+    finally:
+        conn.close()
+
+
+def load_incremental_devices(
+    db_file,
+    state_file,
+    track_keys=False,
+    extract_mode="auto",
+    workers=1,
+    track_metadata=False,
+    window=None,
+):
+    """
+    Classify only the devices added or updated since the watermark stored in
+    state_file and merge them into the category sets kept in the same file
+    (along with the per-target metadata when track_metadata is set).
+    Kismet only ever moves a device's last time and strongest signal up, so
+    a device inside the window stays inside it as long as the window is
+    unchanged.
+
+    Kismet stores devices with ON CONFLICT REPLACE, so an updated device is
+    rewritten with a fresh rowid; the rowid watermark therefore catches both
+    new and updated devices and lets SQLite seek straight to them. The row
+    at the watermark itself is re-read in case it was replaced in place.
+    """
+    db_path = os.path.abspath(db_file)
+    state = read_category_file(state_file) if os.path.isfile(state_file) else None
+    since_rowid = None
+    if state is not None:
+        header, stored = state
+        if header.get("database") != db_path:
+            print(f"\033[33mState file {state_file} belongs to another database\033[0m")
+            state = None
+        elif track_metadata and not header.get("metadata"):
+            print(f"State file {state_file} has no target metadata, reprocessing")
+            state = None
+        elif header.get("window") != (window and list(window)):
+            print(f"State file {state_file} used another device window, reprocessing")
+            state = None
+        else:
+            since_rowid = header.get("watermark_rowid", 0)
+            # Stored as the categories, the device keys and, when tracked,
+            # the metadata rows
+            stored = ClassificationResult(
+                stored[:7],
+                stored[7],
+                metadata_from_strings(stored[8]) if track_metadata else None,
+            )
+
+    try:
+        # Taken before reading so rows written during the run are re-read next time
+        watermark = max_device_rowid(db_file)
+    except Error as e:
+        print("Error querying 'devices' table:", e)
+        return None
+    if since_rowid is not None and watermark < since_rowid:
+        print("\033[33mDevices table shrank since the last run, reprocessing\033[0m")
+        state, since_rowid = None, None
+
+    if since_rowid is not None:
+        print(f"Incremental update of {db_file} from rowid {since_rowid}")
+    delta = load_and_sort_devices(
+        db_file,
+        track_keys=True,
+        extract_mode=extract_mode,
+        workers=workers,
+        since_rowid=since_rowid,
+        track_metadata=track_metadata,
+        window=window,
+    )
+
+    if state is not None:
+        merged = stored
+        if delta is not None:
+            merged = merged.merge(delta)
+    elif delta is not None:
+        merged = delta
+    else:
+        return None
+
+    write_category_file(
+        state_file,
+        {
+            "database": db_path,
+            "watermark_rowid": watermark,
+            "updated": int(time.time()),
+            "metadata": track_metadata,
+            "window": window and list(window),
+        },
+        merged.categories
+        + (merged.keys,)
+        + ((metadata_to_strings(merged.metadata),) if track_metadata else ()),
+    )
+    if not track_keys:
+        merged.keys = None
+    return merged
 
 
 def main():
@@ -551,13 +2988,23 @@ def main():
         "-b",
         "--baseline",
         metavar="BASELINE_DB",
-        help="Path to baseline database file (devices in baseline will be excluded)",
+        action="append",
+        default=[],
+        help="Path to baseline database file (devices in baseline will be excluded). "
+        "May be repeated to exclude devices found in any of several baselines. "
+        "store:STORE_DB[#CAPTURE,...] uses the captures of a target store; "
+        "--export files are accepted as well",
     )
     parser.add_argument(
         "-i",
         "--intersect",
         metavar="INTERSECT_DB",
-        help="Path to intersect database file (only devices common to both databases will be included)",
+        action="append",
+        default=[],
+        help="Path to intersect database file (only devices common to both databases will be included). "
+        "May be repeated to keep only devices found in every intersect database. "
+        "store:STORE_DB[#CAPTURE,...] uses the captures of a target store; "
+        "--export files are accepted as well",
     )
     parser.add_argument(
         "-k",
@@ -565,18 +3012,303 @@ def main():
         metavar="CLEAN_DB_NAME",
         help="Generate a cleaned Kismet database with only extracted devices",
     )
+    parser.add_argument(
+        "-x",
+        "--extract",
+        choices=EXTRACT_MODES,
+        default="auto",
+        help="How device fields are read: json1 projects them inside SQLite, full "
+        "decodes every device blob, auto uses json1 when available (default: auto)",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=1,
+        metavar="N",
+        help="Decode and classify devices in N parallel processes (default: 1)",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=CACHE_DIR,
+        help=f"Cache of classified baseline/intersect databases (default: {CACHE_DIR})",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=CACHE_MAX_MB,
+        metavar="MB",
+        help=f"Size cap of the cache, least recently used entries are evicted "
+        f"(default: {CACHE_MAX_MB})",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Always reclassify baseline/intersect databases",
+    )
+    parser.add_argument(
+        "--immutable",
+        action="store_true",
+        help="Open every Kismet database as immutable, skipping all locking; "
+        "only for finished captures that nothing is writing to anymore",
+    )
+    parser.add_argument(
+        "--since",
+        metavar="TIME",
+        type=parse_time,
+        help="Only use devices last seen at or after TIME (Unix seconds or "
+        "ISO 8601 local time, e.g. '2024-05-01 14:00'), in every database",
+    )
+    parser.add_argument(
+        "--until",
+        metavar="TIME",
+        type=parse_time,
+        help="Only use devices first seen at or before TIME, in every database",
+    )
+    parser.add_argument(
+        "--min-signal",
+        metavar="DBM",
+        type=int,
+        help="Only use devices whose strongest signal is at least DBM "
+        "(e.g. -70), in every database",
+    )
+    parser.add_argument(
+        "--incremental",
+        nargs="?",
+        const="",
+        metavar="STATE_FILE",
+        help="Only process devices added or updated since the last run, merging "
+        f"them into the results kept in STATE_FILE (default: <database>{STATE_SUFFIX})",
+    )
+    parser.add_argument(
+        "-p",
+        "--push",
+        metavar="KISMET_URL",
+        help="Push device targets to a running Kismet over its REST API, "
+        "e.g. http://localhost:2501 (only changes since the last push are sent)",
+    )
+    parser.add_argument(
+        "--kismet-user",
+        help="Kismet REST username for --push",
+    )
+    parser.add_argument(
+        "--kismet-password",
+        default=os.environ.get("KISMET_PASSWORD"),
+        help="Kismet REST password for --push (default: $KISMET_PASSWORD)",
+    )
+    parser.add_argument(
+        "--kismet-apikey",
+        default=os.environ.get("KISMET_APIKEY"),
+        help="Kismet REST API key for --push (default: $KISMET_APIKEY)",
+    )
+    parser.add_argument(
+        "--push-state",
+        default=PUSH_STATE_FILE,
+        metavar="STATE_FILE",
+        help=f"Record of targets already pushed (default: {PUSH_STATE_FILE})",
+    )
+
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Keep running and re-parse the database every time it changes "
+        "(implies --incremental)",
+    )
+    parser.add_argument(
+        "--debounce",
+        type=float,
+        default=WATCH_DEBOUNCE,
+        metavar="SECONDS",
+        help="Wait for writes to pause this long before re-parsing "
+        f"(default: {WATCH_DEBOUNCE})",
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=WATCH_POLL_INTERVAL,
+        metavar="SECONDS",
+        help=f"How often --watch checks the database (default: {WATCH_POLL_INTERVAL})",
+    )
+
+    parser.add_argument(
+        "-r",
+        "--records",
+        metavar="FILE",
+        help="Also write every target with its devkey, manufacturer, common name, "
+        "first/last time, strongest signal and packet count to FILE: JSON Lines "
+        "(.jsonl) or SQLite (.sqlite, .db)",
+    )
+    parser.add_argument(
+        "--store",
+        metavar="STORE_DB",
+        help="Record the targets of every parsed capture, with first/last seen "
+        "time and the captures they were seen in, in this SQLite target store; "
+        "use -b/-i store:STORE_DB[#CAPTURE,...] to compare against it",
+    )
+    parser.add_argument(
+        "--capture-name",
+        metavar="NAME",
+        help="Name of the capture in the target store (default: file name "
+        "without extension)",
+    )
+    parser.add_argument(
+        "--max-targets",
+        metavar="N",
+        type=int,
+        help="Keep only the N most relevant MAC address and probed SSID targets, "
+        "ranked by packets seen, last seen time, strongest signal and whether the "
+        "device has a name or manufacturer",
+    )
+    parser.add_argument(
+        "--target-quota",
+        metavar="CATEGORY=N",
+        type=parse_quota,
+        action="append",
+        default=[],
+        help="Keep at most the N most relevant targets of CATEGORY (one of "
+        + ", ".join(CATEGORY_NAMES)
+        + "); may be repeated",
+    )
+    parser.add_argument(
+        "--batch",
+        action="append",
+        metavar="DIR_OR_GLOB",
+        help="Process every .kismet file in a directory, or matching a glob, "
+        "in parallel and merge them into one set of outputs (may be repeated)",
+    )
+    parser.add_argument(
+        "--provenance",
+        metavar="CSV_FILE",
+        help="With --batch, record which captures each target was found in",
+    )
+    parser.add_argument(
+        "--export",
+        metavar="FILE",
+        help="Write the capture's targets (all --batch captures merged) to a "
+        f"compact exchange file (e.g. capture{EXCHANGE_SUFFIX}) that -b/-i accept "
+        "in place of a Kismet database",
+    )
+    parser.add_argument(
+        "--export-bloom",
+        metavar="RATE",
+        type=float,
+        help="Store every category of the --export file as a Bloom filter with "
+        "this false positive rate (e.g. 0.001), for very large baselines",
+    )
+    parser.add_argument(
+        "-u",
+        "--ubertooth",
+        metavar="SURVEY",
+        help="Ingest `ubertooth-rx -z` survey output from SURVEY ('-' for stdin), "
+        "writing the unique addresses to <SURVEY>_UAP and <SURVEY>_LAP",
+    )
+    parser.add_argument(
+        "--ubertooth-output",
+        metavar="PREFIX",
+        help="Prefix of the Ubertooth survey outputs (default: SURVEY, or "
+        "'ubertooth' when reading stdin)",
+    )
+    parser.add_argument(
+        "--ubertooth-targets",
+        action="store_true",
+        help="Also add the surveyed UAP/LAP addresses, and the full addresses "
+        "they resolve to, to the BR/EDR targets",
+    )
+    parser.add_argument(
+        "--ubertooth-index",
+        action="append",
+        default=[],
+        metavar="INDEX_DB",
+        help="Resolve survey addresses to full BR/EDR addresses seen in this "
+        "Kismet database (may be repeated)",
+    )
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="Report time, throughput, bytes read, JSON errors and peak memory "
+        "per stage, and devices per category",
+    )
+    parser.add_argument(
+        "--stats-json",
+        metavar="FILE",
+        help="Write the --stats report to FILE as JSON",
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="DIR",
+        help="Write cProfile data of load_and_sort_devices and "
+        "generate_cleaned_database to DIR",
+    )
 
     args = parser.parse_args()
 
-    # Check for mutually exclusive options
-    if args.baseline and args.intersect:
+    if args.stats or args.stats_json or args.profile:
+        global STATS
+        STATS = RunStats(profile_dir=args.profile)
+    if args.immutable:
+        global IMMUTABLE_CAPTURES
+        IMMUTABLE_CAPTURES = True
+
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.batch:
+        if args.database:
+            parser.error("--batch replaces the database argument")
+        for option, name in (
+            (args.kismet_cleaned, "-k"),
+            (args.incremental is not None, "--incremental"),
+            (args.watch, "--watch"),
+        ):
+            if option:
+                parser.error(f"{name} cannot be combined with --batch")
+        if args.records:
+            parser.error("--records cannot be combined with --batch")
+        if args.capture_name:
+            parser.error("--capture-name cannot be combined with --batch")
+    elif args.provenance:
+        parser.error("--provenance requires --batch")
+    if args.records and record_format(args.records) is None:
         parser.error(
-            "--baseline and --intersect cannot be used together. Choose one filtering method."
+            "--records file must end in one of: " + ", ".join(sorted(RECORD_FORMATS))
         )
+    args.window = device_window(args.since, args.until, args.min_signal)
+    if args.since is not None and args.until is not None and args.since > args.until:
+        parser.error("--since must not be later than --until")
+    if args.export_bloom is not None:
+        if not args.export:
+            parser.error("--export-bloom requires --export")
+        if not 0 < args.export_bloom < 1:
+            parser.error("--export-bloom must be between 0 and 1")
+    if args.max_targets is not None and args.max_targets < 0:
+        parser.error("--max-targets must not be negative")
+    if args.immutable and (args.watch or args.incremental is not None):
+        parser.error("--immutable is for finished captures, not --watch/--incremental")
+    if args.watch:
+        if not args.database:
+            parser.error("--watch requires a database")
+        if args.incremental is None:
+            args.incremental = ""
+
+    session = None
+    if args.push:
+        try:
+            session = KismetRestSession(
+                args.push,
+                user=args.kismet_user,
+                password=args.kismet_password,
+                apikey=args.kismet_apikey,
+            )
+        except ValueError as e:
+            parser.error(str(e))
 
     if args.clean:
         clean_intermediate_files()
-        if not args.database and not args.add_targets and not args.delete_targets:
+        if (
+            not args.database
+            and not args.batch
+            and not args.add_targets
+            and not args.delete_targets
+        ):
             return
 
     if args.delete_targets:
@@ -595,129 +3327,665 @@ def main():
         generate_target_alerts_from_files()
         return
 
-    if not args.database:
+    if not args.database and not args.batch and not args.ubertooth:
         parser.print_help()
-        print("\nError: Database file is required unless using -a, -c, or -d flags")
+        print("\nError: Database file is required unless using -a, -c, -d or -u flags")
         sys.exit(1)
 
-    if args.exclude_files and os.geteuid() != 0:
+    if (args.database or args.batch) and args.exclude_files and os.geteuid() != 0:
         print("\033[31mPermission Error: Restarting with sudo...\033[0m")
         subprocess.call(["sudo", sys.executable] + sys.argv)
         sys.exit()
 
-    # Load new database devices (track keys if we need to generate cleaned database)
-    new_data = load_and_sort_devices(
-        args.database, track_keys=bool(args.kismet_cleaned)
-    )
-    if new_data is None:
-        print("No devices found in new database")
+    # Ubertooth survey addresses, merged into the BR/EDR targets on request
+    args.survey_macs = None
+    if args.ubertooth:
+        prefix = args.ubertooth_output or (
+            "ubertooth" if args.ubertooth == "-" else args.ubertooth
+        )
+        index = None
+        if args.ubertooth_index:
+            index = load_bluetooth_index(
+                args.ubertooth_index,
+                extract_mode=args.extract,
+                workers=args.workers,
+                cache_dir=None if args.no_cache else args.cache_dir,
+            )
+        uap_hits, _, resolved = ingest_ubertooth_survey(args.ubertooth, prefix, index)
+        if not args.database and not args.batch:
+            return
+        if args.ubertooth_targets:
+            args.survey_macs = mac_array(
+                sorted(set(map(mac_to_int, uap_hits)) | resolved)
+            )
+
+    if args.watch:
+        try:
+            asyncio.run(watch_capture(args, session))
+        except KeyboardInterrupt:
+            print(f"Stopped watching {args.database}")
+        return
+
+    found = process_capture(args, session)
+    report_stats(args)
+    if not found:
         sys.exit(1)
 
-    # Extract keys if tracking
-    extracted_keys = None
-    if args.kismet_cleaned:
-        extracted_keys = new_data[-1]
-        new_data = new_data[:-1]  # Remove keys from tuple for further processing
-
-    # Load and subtract baseline if requested
-    if args.baseline:
-        base_data = load_and_sort_devices(args.baseline)
-        if base_data is not None:
-            print(f"Applying baseline filter using {args.baseline}")
-            new_data = subtract_baseline(new_data, base_data)
-        else:
-            print("\033[33mWarning: Baseline database empty or invalid\033[0m")
-
-    # Load and intersect with intersect database if requested
-    if args.intersect:
-        intersect_data = load_and_sort_devices(args.intersect)
-        if intersect_data is not None:
-            print(f"Applying intersect filter using {args.intersect}")
-            new_data = intersect_baseline(new_data, intersect_data)
+
+def process_capture(args, session=None):
+    """
+    Parse args.database (or every --batch capture) and write every requested
+    output. Returns False when no devices were found.
+    """
+    # Load new database devices (track keys if we need to generate cleaned database)
+    batch_files = batch_datas = None
+    # Per-target metadata feeds --records, the store's first/last seen and
+    # target ranking
+    ranking = args.max_targets is not None or bool(args.target_quota)
+    track_metadata = bool(args.records or args.store or ranking)
+    with STATS.stage("load"):
+        if args.batch:
+            batch_files = expand_batch(args.batch)
+            if not batch_files:
+                print("\033[31mError: No .kismet files matched --batch\033[0m")
+                return False
+            batch_datas = load_batch(
+                batch_files,
+                extract_mode=args.extract,
+                workers=args.workers,
+                cache_dir=None if args.no_cache else args.cache_dir,
+                cache_max_mb=args.cache_size,
+                window=args.window,
+                track_metadata=track_metadata,
+            )
+            result = merge_sorted_results(batch_datas)
+        elif args.incremental is not None:
+            result = load_incremental_devices(
+                args.database,
+                args.incremental or args.database + STATE_SUFFIX,
+                track_keys=bool(args.kismet_cleaned),
+                extract_mode=args.extract,
+                workers=args.workers,
+                track_metadata=track_metadata,
+                window=args.window,
+            )
         else:
-            print("\033[33mWarning: Intersect database empty or invalid\033[0m")
-
-    (
-        btedr_macs,
-        btle_macs,
-        client_macs,
-        ap_macs,
-        sensor_macs,
-        advertised_ssids,
-        probed_ssids,
-    ) = new_data
+            result = load_and_sort_devices(
+                args.database,
+                track_keys=bool(args.kismet_cleaned),
+                extract_mode=args.extract,
+                workers=args.workers,
+                track_metadata=track_metadata,
+                window=args.window,
+            )
+    if result is None:
+        print("No devices found in new database")
+        return False
+
+    if args.export:
+        with STATS.stage("export"):
+            result.write_exchange(
+                args.export,
+                args.export_bloom,
+                {
+                    "source": (
+                        f"{len(batch_files)} captures"
+                        if args.batch
+                        else os.path.basename(args.database)
+                    ),
+                    "created": int(time.time()),
+                    "window": args.window and list(args.window),
+                },
+            )
+        print(
+            f"Exported {result.count()} targets to {args.export} "
+            f"({os.path.getsize(args.export)} bytes)"
+        )
+
+    targets = result
+    if args.survey_macs:
+        # Ubertooth sightings join the capture's own BR/EDR devices
+        targets = result.copy()
+        targets.btedr = sorted_union(targets.btedr, args.survey_macs)
+    STATS.categories("capture", targets)
+
+    cache_dir = None if args.no_cache else args.cache_dir
+
+    # Load every baseline and intersect database concurrently, then apply
+    # them together: new & intersect_1 & ... - baseline_1 - ...
+    reference_files = args.intersect + args.baseline
+    if reference_files:
+        with STATS.stage("references"):
+            references = load_references(
+                reference_files,
+                extract_mode=args.extract,
+                workers=args.workers,
+                cache_dir=cache_dir,
+                cache_max_mb=args.cache_size,
+                exclude_captures=batch_files or [args.database],
+                window=args.window,
+            )
+        intersect_datas = []
+        baseline_datas = []
+        for index, (db_file, data) in enumerate(zip(reference_files, references)):
+            kind = "intersect" if index < len(args.intersect) else "baseline"
+            if data is None:
+                print(
+                    f"\033[33mWarning: {kind.capitalize()} database empty or invalid: "
+                    f"{db_file}\033[0m"
+                )
+                continue
+            print(f"Applying {kind} filter using {db_file}")
+            if kind == "intersect":
+                intersect_datas.append(data)
+            else:
+                baseline_datas.append(data)
+        with STATS.stage("set_algebra"):
+            targets = targets.combine(intersect_datas, baseline_datas)
+        STATS.categories("targets", targets)
+
+    if ranking:
+        with STATS.stage("rank"):
+            # Intermediate files feed -a, which also alerts on SSID.txt
+            targets = targets.ranked(
+                args.max_targets,
+                dict(args.target_quota),
+                ALERT_CATEGORIES if args.exclude_files else FILE_ALERT_CATEGORIES,
+            )
+        STATS.categories("ranked", targets)
+
+    if args.provenance:
+        write_provenance(args.provenance, targets, batch_files, batch_datas)
+
+    if args.records:
+        with STATS.stage("records"):
+            targets.write_records(args.records)
 
     # Write results
-    if not args.exclude_files:
-        # Default behavior: generate intermediate text files
-        generate_intermediate_files(
-            btedr_macs,
-            btle_macs,
-            client_macs,
-            ap_macs,
-            sensor_macs,
-            advertised_ssids,
-            probed_ssids,
+    with STATS.stage("write_outputs"):
+        if not args.exclude_files:
+            # Default behavior: generate intermediate text files
+            targets.write_files()
+        else:
+            # Directly generate alerts without intermediate files
+            targets.write_alerts()
+
+    if args.push:
+        with STATS.stage("push"):
+            push_target_alerts(
+                session,
+                targets.btedr,
+                targets.btle,
+                targets.client,
+                targets.ap,
+                targets.sensor,
+                targets.probed_ssids,
+                state_file=args.push_state,
+            )
+
+    # Generate cleaned Kismet database if requested
+    if args.kismet_cleaned and result.keys is not None:
+        with STATS.stage("cleaned_database"):
+            result.write_cleaned_database(args.database, args.kismet_cleaned)
+
+    # Record what this run saw, before any baseline/intersect filtering
+    if args.store and args.window is not None:
+        print(
+            f"\033[33mWarning: Not updating target store {args.store}: "
+            "--since/--until/--min-signal read only part of the capture\033[0m"
         )
-    else:
-        # Directly generate alerts without intermediate files
-        generate_target_alerts(
-            btedr_macs, btle_macs, client_macs, ap_macs, sensor_macs, probed_ssids
+    elif args.store:
+        with STATS.stage("store"):
+            if args.batch:
+                for db_file, data in zip(batch_files, batch_datas):
+                    if data is not None:
+                        upsert_target_store(
+                            args.store, db_file, capture_name(db_file), data
+                        )
+            else:
+                upsert_target_store(
+                    args.store,
+                    args.database,
+                    args.capture_name or capture_name(args.database),
+                    result,
+                )
+    return True
+
+
+def capture_name(db_file):
+    """Default name of a capture in the target store: its file name stem"""
+    return Path(db_file).stem
+
+
+def record_format(path):
+    """Output format of a --records file, from its extension (None if unknown)"""
+    return RECORD_FORMATS.get(os.path.splitext(path)[1].lower())
+
+
+def iter_target_records(targets, metadata):
+    """
+    One (category, target, *RECORD_FIELDS) tuple per final target, in
+    category order and sorted target order.
+    """
+    empty = DeviceRecord()
+    for position, (name, values) in enumerate(zip(CATEGORY_NAMES, targets)):
+        for value, target in zip(values, target_lines(values)):
+            yield (name, target, *metadata.get((position, value), empty))
+
+
+def device_score(record):
+    """The part of target_score() that depends only on the device itself"""
+    score = math.log2(1 + (record.packets or 0))
+    if record.strongest_signal:  # 0 means Kismet has no signal reading
+        score += (record.strongest_signal - RANK_SIGNAL_FLOOR) / RANK_SIGNAL_DB
+    named = isinstance(record.commonname, str) and mac_to_int(record.commonname) is None
+    if named or record.manuf not in (None, "", "Unknown"):
+        score += RANK_NAMED_BONUS
+    return score
+
+
+def target_score(record, newest):
+    """
+    Relevance of one target's DeviceRecord, as weighted by the RANK_
+    constants. An SSID's merged record holds the best packets, signal and
+    name of all its devices, which would outrank any single address, so it
+    is scored from its per-device sightings instead.
+    """
+    score = 0.0
+    if newest is not None and record.last_time is not None:
+        score -= (newest - record.last_time) / 3600 / RANK_RECENCY_HOURS
+    if record.sightings:
+        scores = record.sightings.values()
+        return score + sum(scores) / len(scores) + math.log2(len(scores))
+    return score + device_score(record)
+
+
+def rank_targets(result, max_targets=None, quotas=None, capped=ALERT_CATEGORIES):
+    """
+    Keep the most relevant targets of result, scored by target_score() from
+    the metadata gathered during classification: at most quotas[category]
+    of each category, then at most max_targets across the capped categories.
+    Equal scores keep category and target order. Returns a new
+    ClassificationResult with sorted categories.
+    """
+    quotas = quotas or {}
+    metadata = result.metadata or {}
+    empty = DeviceRecord()
+    newest = max(
+        (record.last_time for record in metadata.values() if record.last_time),
+        default=None,
+    )
+    scored = {}
+    for position, (name, values) in enumerate(zip(CATEGORY_NAMES, result.categories)):
+        ranked = [
+            (target_score(metadata.get((position, value), empty), newest), value)
+            for value in values
+        ]
+        if name in quotas:
+            ranked = heapq.nlargest(quotas[name], ranked, key=lambda entry: entry[0])
+        scored[name] = ranked
+
+    if max_targets is not None:
+        pool = [(entry, name) for name in capped for entry in scored[name]]
+        if len(pool) > max_targets:
+            for name in capped:
+                scored[name] = []
+            for entry, name in heapq.nlargest(
+                max_targets, pool, key=lambda item: item[0][0]
+            ):
+                scored[name].append(entry)
+
+    categories = []
+    for name, values in zip(CATEGORY_NAMES, result.categories):
+        kept = like(values, sorted(value for _, value in scored[name]))
+        if len(kept) < len(values):
+            print(f"  {name}: kept {len(kept)} of {len(values)} targets")
+        categories.append(kept)
+    ranked = ClassificationResult(categories, result.keys, result.metadata)
+    print(f"Ranked targets: kept {ranked.count()} of {result.count()}")
+    return ranked
+
+
+def parse_quota(value):
+    """argparse type for --target-quota: CATEGORY=N"""
+    name, _, count = value.partition("=")
+    if name not in CATEGORY_NAMES or not count.isdigit():
+        raise argparse.ArgumentTypeError(
+            f"invalid quota {value!r}, expected CATEGORY=N with CATEGORY one of "
+            + ", ".join(CATEGORY_NAMES)
         )
+    return name, int(count)
 
-    # Generate cleaned Kismet database if requested
-    if args.kismet_cleaned and extracted_keys is not None:
-        generate_cleaned_database(args.database, args.kismet_cleaned, extracted_keys)
 
+def write_target_records(path, targets, metadata):
+    """
+    Stream every final target with its metadata to a JSON Lines file, or to
+    a SQLite file with a targets table indexed by target and last time. The
+    file is built under a temporary name and renamed into place.
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    columns = ("category", "target") + RECORD_FIELDS
+    count = 0
+    if record_format(path) == "jsonl":
+        with open(tmp_path, "w") as f:
+            for row in iter_target_records(targets, metadata):
+                f.write(json.dumps(dict(zip(columns, row))) + "\n")
+                count += 1
+    else:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        conn = sqlite3.connect(tmp_path)
+        try:
+            conn.execute(
+                "CREATE TABLE targets (category TEXT NOT NULL, target TEXT NOT NULL, "
+                "devkey TEXT, manuf TEXT, commonname TEXT, first_time INTEGER, "
+                "last_time INTEGER, strongest_signal INTEGER, packets INTEGER, "
+                "PRIMARY KEY (category, target))"
+            )
+            cursor = conn.executemany(
+                f"INSERT INTO targets VALUES ({placeholders(columns)})",
+                iter_target_records(targets, metadata),
+            )
+            count = cursor.rowcount
+            conn.execute("CREATE INDEX targets_target ON targets (target)")
+            conn.execute("CREATE INDEX targets_last_time ON targets (last_time)")
+            conn.commit()
+        finally:
+            conn.close()
+    os.replace(tmp_path, path)
+    print(f"{count} target records written to {path}")
+
+
+def expand_batch(patterns):
+    """Capture files named by --batch directories and glob patterns, sorted"""
+    files = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, "*.kismet")
+        files.update(path for path in glob.glob(pattern) if os.path.isfile(path))
+    return sorted(files)
+
+
+def load_batch(
+    db_files,
+    extract_mode="auto",
+    workers=1,
+    cache_dir=None,
+    cache_max_mb=CACHE_MAX_MB,
+    window=None,
+    track_metadata=False,
+):
+    """
+    Classify a batch of captures, one process per capture across all cores,
+    through the same cache as baseline databases (bypassed for reads when
+    track_metadata is set). Returns the categories of each capture in order
+    (None for empty or invalid ones).
+    """
+    print(f"Processing {len(db_files)} captures in batch mode")
+    datas = load_references(
+        db_files,
+        extract_mode=extract_mode,
+        workers=workers,
+        cache_dir=cache_dir,
+        cache_max_mb=cache_max_mb,
+        window=window,
+        track_metadata=track_metadata,
+    )
+    for db_file, data in zip(db_files, datas):
+        if data is None:
+            print(f"\033[33mWarning: Capture empty or invalid: {db_file}\033[0m")
+    return datas
 
-def generate_cleaned_database(source_db, dest_db, extracted_keys):
-    """Copy database and remove devices that weren't extracted"""
-    # Copy the original database
-    try:
-        shutil.copy2(source_db, dest_db)
-        print(f"Copied database to {dest_db}")
-    except Exception as e:
-        print(f"\033[31mError copying database: {e}\033[0m")
-        sys.exit(1)
 
-    # Connect to the copied database and remove non-extracted devices
+def write_provenance(path, targets, db_files, datas):
+    """
+    Write a CSV of every final target with the captures it was found in:
+    category,target,captures,files (files separated by ';').
+    """
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["category", "target", "captures", "files"])
+        for position, (name, values) in enumerate(
+            zip(CATEGORY_NAMES, targets.categories)
+        ):
+            sources = {}
+            for db_file, data in zip(db_files, datas):
+                if data is None:
+                    continue
+                for value in sorted_intersection(values, data.categories[position]):
+                    sources.setdefault(value, []).append(os.path.basename(db_file))
+            for value, value_line in zip(values, target_lines(values)):
+                files = sources.get(value, [])
+                writer.writerow([name, value_line, len(files), ";".join(files)])
+    print(f"Target provenance written to {path}")
+
+
+def report_stats(args):
+    """Print and/or save the --stats report of the last run, then start afresh"""
+    if not STATS.enabled:
+        return
+    if args.stats:
+        STATS.print_report()
+    if args.stats_json:
+        write_file_atomically(args.stats_json, json.dumps(STATS.as_dict(), indent=2))
+        print(f"Statistics written to {args.stats_json}")
+    STATS.reset()
+
+
+def capture_signature(db_file):
+    """(size, mtime) of a capture and its WAL, which change on every write"""
+    signature = []
+    for path in (db_file, db_file + "-wal"):
+        try:
+            st = os.stat(path)
+            signature.append((st.st_size, st.st_mtime_ns))
+        except OSError:
+            signature.append(None)
+    return tuple(signature)
+
+
+async def watch_for_changes(db_file, queue, poll_interval, debounce):
+    """
+    Queue a parse whenever the capture or its WAL changes. Bursts of writes
+    are debounced until the files have been quiet for debounce seconds, and
+    the queue holds at most one pending parse, so changes arriving while a
+    parse is running collapse into a single follow-up run.
+    """
+    last = None
+    while True:
+        signature = capture_signature(db_file)
+        if signature != last:
+            changed_at = time.monotonic()
+            while True:
+                await asyncio.sleep(debounce)
+                settled = capture_signature(db_file)
+                if settled == signature:
+                    break
+                signature = settled
+            last = signature
+            if not queue.full():
+                queue.put_nowait(changed_at)
+        await asyncio.sleep(poll_interval)
+
+
+async def watch_capture(args, session=None):
+    """Re-parse a live capture every time Kismet writes to it"""
+    queue = asyncio.Queue(maxsize=1)
+    watcher = asyncio.create_task(
+        watch_for_changes(args.database, queue, args.poll_interval, args.debounce)
+    )
+    loop = asyncio.get_running_loop()
+    print(f"Watching {args.database} for changes (Ctrl+C to stop)")
     try:
-        conn = sqlite3.connect(dest_db)
-        cursor = conn.cursor()
+        while True:
+            changed_at = await queue.get()
+            started = time.monotonic()
+            try:
+                await loop.run_in_executor(None, process_capture, args, session)
+            except SystemExit:
+                print("\033[31mParse failed, waiting for the next change\033[0m")
+            except Exception as e:
+                # A capture caught mid-write or a full disk must not end the
+                # daemon; the next change gets a fresh attempt
+                print(
+                    f"\033[31mParse failed ({type(e).__name__}: {e}), "
+                    "waiting for the next change\033[0m"
+                )
+            report_stats(args)
+            finished = time.monotonic()
+            print(
+                f"Cycle finished in {finished - started:.2f}s "
+                f"({finished - changed_at:.2f}s after the change), "
+                f"queue depth {queue.qsize()}"
+            )
+    finally:
+        watcher.cancel()
 
-        # Get total device count before deletion
-        cursor.execute("SELECT COUNT(*) FROM devices")
-        total_before = cursor.fetchone()[0]
 
-        if extracted_keys:
-            # Create placeholders for the IN clause
-            placeholders = ",".join(["?" for _ in extracted_keys])
-            # Delete devices whose keys are NOT in the extracted_keys list
-            cursor.execute(
-                f"DELETE FROM devices WHERE devkey NOT IN ({placeholders})",
-                extracted_keys,
+def copy_schema(conn, schema, kinds):
+    """Recreate the source schema objects of the given kinds in the main database"""
+    for kind, name, sql in schema:
+        if kind in kinds:
+            conn.execute(sql)
+
+
+def prune_predicate(columns):
+    """
+    SQL condition keeping rows of a table that belong to a kept device, or
+    None for tables that are not keyed by device (copied unchanged).
+    Rows are matched on device key first, then on phy name and MAC.
+    """
+    if "devkey" in columns:
+        return "s.devkey IN (SELECT devkey FROM temp.keep_keys)"
+    if "devmac" in columns and "phyname" in columns:
+        return "(s.phyname, s.devmac) IN (SELECT phyname, devmac FROM temp.keep_macs)"
+    if "devmac" in columns:
+        return "s.devmac IN (SELECT devmac FROM temp.keep_macs)"
+    return None
+
+
+def copy_table_rows(conn, name, predicate):
+    """
+    Copy the rows of src.name matching predicate into main.name in batches
+    of PRUNE_BATCH_ROWS source rowids. Returns (rows before, rows after).
+    """
+    total = conn.execute(f'SELECT COUNT(*) FROM src."{name}"').fetchone()[0]
+    condition = f" WHERE {predicate}" if predicate else ""
+    try:
+        low, high = conn.execute(
+            f'SELECT MIN(rowid), MAX(rowid) FROM src."{name}"'
+        ).fetchone()
+    except Error:
+        low = high = None  # WITHOUT ROWID table, copy it in one statement
+    if low is None:
+        conn.execute(
+            f'INSERT INTO main."{name}" SELECT s.* FROM src."{name}" AS s{condition}'
+        )
+    else:
+        condition = f" AND {predicate}" if predicate else ""
+        for start in range(low, high + 1, PRUNE_BATCH_ROWS):
+            conn.execute(
+                f'INSERT INTO main."{name}" SELECT s.* FROM src."{name}" AS s '
+                f"WHERE s.rowid BETWEEN ? AND ?{condition}",
+                (start, start + PRUNE_BATCH_ROWS - 1),
             )
-        else:
-            # If no devices were extracted, delete all devices
-            cursor.execute("DELETE FROM devices")
+    kept = conn.execute(f'SELECT COUNT(*) FROM main."{name}"').fetchone()[0]
+    return total, kept
 
-        conn.commit()
 
-        # Get device count after deletion
-        cursor.execute("SELECT COUNT(*) FROM devices")
-        total_after = cursor.fetchone()[0]
+@profiled
+def generate_cleaned_database(source_db, dest_db, extracted_keys):
+    """
+    Build a new database holding only the extracted devices. The source is
+    attached read-only, the kept keys are loaded into an indexed temp table
+    and only matching device rows are copied, so the result is compact from
+    the start and the work grows with the kept set rather than the capture.
+    Packets, data, alerts and any other table keyed by device key or MAC are
+    pruned to the kept devices the same way; per-table row counts are
+    reported.
+    """
+    tmp_db = f"{dest_db}.tmp"
+    for path in (tmp_db, f"{tmp_db}-journal"):
+        if os.path.exists(path):
+            os.remove(path)
 
-        deleted_count = total_before - total_after
-        print(f"\033[32mCleaned database created: {dest_db}\033[0m")
-        print(
-            f"  Removed {deleted_count} devices, kept {total_after} extracted devices"
+    try:
+        conn = sqlite3.connect(Path(tmp_db).resolve().as_uri(), uri=True)
+        # A fresh file that is renamed into place once complete needs no journal
+        conn.execute("PRAGMA journal_mode=OFF")
+        conn.execute("PRAGMA synchronous=OFF")
+        conn.execute("ATTACH DATABASE ? AS src", (capture_uri(source_db),))
+        conn.execute(f"PRAGMA src.mmap_size={read_mmap_size()}")
+        # Copy every table from one snapshot of the source, so packets, data
+        # and alerts match the devices kept even while Kismet keeps writing
+        conn.execute("BEGIN")
+        schema = conn.execute(
+            "SELECT type, name, sql FROM src.sqlite_master "
+            "WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%' ORDER BY rowid"
+        ).fetchall()
+        user_version = conn.execute("PRAGMA src.user_version").fetchone()[0]
+        conn.execute(f"PRAGMA main.user_version={int(user_version)}")
+
+        # Tables first; indexes and triggers are built after the bulk copy
+        copy_schema(conn, schema, ("table",))
+
+        conn.execute(
+            "CREATE TEMP TABLE keep_keys (devkey TEXT PRIMARY KEY) WITHOUT ROWID"
+        )
+        conn.executemany(
+            "INSERT OR IGNORE INTO temp.keep_keys VALUES (?)",
+            ((key,) for key in extracted_keys),
         )
 
+        total_before, total_after = copy_table_rows(
+            conn, "devices", prune_predicate({"devkey"})
+        )
+        conn.execute(
+            "CREATE TEMP TABLE keep_macs (phyname TEXT, devmac TEXT, "
+            "PRIMARY KEY (phyname, devmac)) WITHOUT ROWID"
+        )
+        conn.execute(
+            "INSERT OR IGNORE INTO temp.keep_macs SELECT phyname, devmac FROM main.devices"
+        )
+
+        table_counts = []
+        for kind, name, _ in schema:
+            if kind != "table" or name == "devices":
+                continue
+            columns = {
+                row[1] for row in conn.execute(f'PRAGMA src.table_info("{name}")')
+            }
+            predicate = prune_predicate(columns)
+            before, after = copy_table_rows(conn, name, predicate)
+            table_counts.append((name, before, after, predicate is not None))
+
+        copy_schema(conn, schema, ("index", "trigger", "view"))
+        # Lets --since/--until/--min-signal runs on the cleaned copy seek
+        # straight to the window instead of scanning every device row
+        if {"first_time", "last_time", "strongest_signal"} <= {
+            row[1] for row in conn.execute("PRAGMA main.table_info(devices)")
+        }:
+            conn.execute(
+                f"CREATE INDEX IF NOT EXISTS main.{WINDOW_INDEX} ON devices "
+                "(last_time, first_time, strongest_signal)"
+            )
+        conn.commit()
+        conn.execute("DETACH DATABASE src")
         conn.close()
+        os.replace(tmp_db, dest_db)
     except Error as e:
         print(f"\033[31mError cleaning database: {e}\033[0m")
+        if os.path.exists(tmp_db):
+            os.remove(tmp_db)
         sys.exit(1)
 
+    deleted_count = total_before - total_after
+    print(f"\033[32mCleaned database created: {dest_db}\033[0m")
+    print(f"  Removed {deleted_count} devices, kept {total_after} extracted devices")
+    for name, before, after, pruned in table_counts:
+        note = "" if pruned else " (not keyed by device, copied unchanged)"
+        print(f"  {name}: {before} -> {after} rows{note}")
+
 
 if __name__ == "__main__":
     main()